@@ -8,6 +8,7 @@ from typing import Dict, Any, Optional
 from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 import re
+import urllib.request
 
 import yaml
 
@@ -712,10 +713,33 @@ class SDMultiplayerController:
                 logger.error(f"获取后端部署 {name}-backend 的资源请求时出错: {e}")
                 raise
 
+    async def _scrape_backend_metrics(self, label_selector: str, names) -> Dict[str, float]:
+        """直接抓取每个运行中后端 Pod 的 /metrics，把指定的 gauge 按 Pod 求和"""
+        totals = {metric_name: 0.0 for metric_name in names}
+        pods = self.v1.list_namespaced_pod(namespace=self.namespace, label_selector=label_selector)
+
+        def fetch(pod_ip: str) -> str:
+            with urllib.request.urlopen(f"http://{pod_ip}:7860/metrics", timeout=5) as response:
+                return response.read().decode('utf-8')
+
+        for pod in pods.items:
+            if pod.status.phase != 'Running' or not pod.status.pod_ip:
+                continue
+            try:
+                text = await asyncio.to_thread(fetch, pod.status.pod_ip)
+            except Exception as e:
+                logger.warning(f"抓取 Pod {pod.metadata.name} 的指标失败: {e}")
+                continue
+            for line in text.splitlines():
+                parts = line.split()
+                if len(parts) == 2 and parts[0] in totals:
+                    totals[parts[0]] += float(parts[1])
+        return totals
+
     async def _get_load_metrics(self, name: str) -> Dict[str, Any]:
         """
         从 Kubernetes Metrics Server 获取 CPU/内存负载指标.
-        TODO: 从 Prometheus 获取自定义指标.
+        生成任务数和排队数从各后端 Pod 的 /metrics 直接抓取.
         """
         logger.info(f"正在为实例 {name} 获取负载指标...")
         
@@ -726,8 +750,8 @@ class SDMultiplayerController:
         metrics = {
             'cpu_usage_percent': 0,
             'memory_usage_percent': 0,
-            'active_jobs': 0, # TODO: 从 Prometheus 获取
-            'queue_length': 0  # TODO: 从 Prometheus 获取
+            'active_jobs': 0,
+            'queue_length': 0
         }
 
         # --- 1. 从 Metrics Server 获取 CPU 和内存使用情况 ---
@@ -779,21 +803,15 @@ class SDMultiplayerController:
         except Exception as e:
             logger.error(f"处理指标数据时发生未知错误: {e}")
 
-        # --- 2. TODO: 从 Prometheus 获取自定义指标 ---
-        # 以下是示例逻辑，您需要替换为对 Prometheus 的真实查询
+        # --- 2. 从后端 Pod 的 /metrics 获取自定义指标 ---
         try:
-            # 假设您的应用暴露了名为 `sd_active_jobs` 和 `sd_queue_length` 的指标
-            # metrics['active_jobs'] = await self._query_prometheus("sum(sd_active_jobs{instance='" + name + "'})")
-            # metrics['queue_length'] = await self._query_prometheus("sum(sd_queue_length{instance='" + name + "'})")
-            
-            # 在您实现 Prometheus 查询前，我们暂时返回一个模拟值
-            import random
-            metrics['active_jobs'] = random.randint(1, 10)
-            metrics['queue_length'] = random.randint(0, 20)
-            logger.info(f"实例 {name} 的自定义指标 (模拟): ActiveJobs={metrics['active_jobs']}, QueueLength={metrics['queue_length']}")
+            backend_metrics = await self._scrape_backend_metrics(label_selector, ('sd_active_jobs', 'sd_queue_length'))
+            metrics['active_jobs'] = int(backend_metrics['sd_active_jobs'])
+            metrics['queue_length'] = int(backend_metrics['sd_queue_length'])
+            logger.info(f"实例 {name} 的自定义指标: ActiveJobs={metrics['active_jobs']}, QueueLength={metrics['queue_length']}")
 
         except Exception as e:
-            logger.error(f"从 Prometheus 获取自定义指标时出错: {e}")
+            logger.error(f"从后端获取自定义指标时出错: {e}")
 
         return metrics
 
@@ -6,27 +6,45 @@ import logging
 import sys
 import traceback
 import time
+import json
+import hashlib
+import hmac
+import struct
+import threading
+import weakref
+import queue
+import random
+import contextvars
+import atexit
+import mimetypes
+from bisect import bisect_left
+from email.utils import formatdate, parsedate_to_datetime
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 from pathlib import Path
 import uvicorn
 
 
 # 新增的 import，用于调用外部 API
 import base64
-import requests
+import asyncio
+import httpx
 
 # 用于加载 .env 文件
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, HTTPException, UploadFile, Depends, status, Request
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, UploadFile, status, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_utils.tasks import repeat_every
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
 import glob
 
 
-import numpy as np
-from PIL import Image
+from PIL import Image, ImageStat
 import gradio as gr
 import shortuuid
 import re
@@ -38,38 +56,211 @@ import magic # 假设您保留了 create_upload_file 功能
 load_dotenv()
 STABILITY_API_KEY = os.environ.get("STABILITY_API_KEY")
 LIVEBLOCKS_SECRET = os.environ.get("LIVEBLOCKS_SECRET")
+LIVEBLOCKS_WEBHOOK_SECRET = os.environ.get("LIVEBLOCKS_WEBHOOK_SECRET")
+
+# 出站 HTTP 客户端配置（连接池、并发上限、超时，单位：秒）
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_MAX_IN_FLIGHT = int(os.environ.get("HTTP_MAX_IN_FLIGHT", "8"))
+# Liveblocks REST 调用（房间人数同步、授权）单独限流，批量同步不会占满生成请求的出站名额
+LIVEBLOCKS_MAX_IN_FLIGHT = int(os.environ.get("LIVEBLOCKS_MAX_IN_FLIGHT", "8"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "15"))
+STABILITY_READ_TIMEOUT = float(os.environ.get("STABILITY_READ_TIMEOUT", "120"))
+
+# Stability API 调用的重试和熔断配置。STABILITY_API_URL 可以指向本地的故障注入桩（fault_stub.py）
+STABILITY_API_URL = os.environ.get("STABILITY_API_URL", "https://api.stability.ai/v2beta/stable-image/generate/sd3")
+STABILITY_MAX_RETRIES = int(os.environ.get("STABILITY_MAX_RETRIES", "3"))
+STABILITY_BACKOFF_BASE = float(os.environ.get("STABILITY_BACKOFF_BASE", "0.5"))
+STABILITY_BACKOFF_MAX = float(os.environ.get("STABILITY_BACKOFF_MAX", "10"))
+# 需要在本地等待（429 的 Retry-After 或令牌桶排队）超过该值时不再等待，直接把 retry_after 返回给客户端
+STABILITY_RETRY_AFTER_MAX = float(os.environ.get("STABILITY_RETRY_AFTER_MAX", "30"))
+
+# Stability API key 池。STABILITY_API_KEYS 用逗号分隔多个条目，每个条目为
+#   key[;weight=2][;rate=1.5][;burst=3][;url=https://...]
+# 未配置时退回到单个 STABILITY_API_KEY + STABILITY_API_URL。
+# rate/burst 是每个 key 的令牌桶（每秒请求数、突发容量），默认取 STABILITY_KEY_RATE / STABILITY_KEY_BURST；
+# STABILITY_KEY_SELECTION 为 least_loaded（默认，按预计等待时间和在途请求数/权重选择）或 weighted（平滑加权轮询）。
+STABILITY_API_KEYS = os.environ.get("STABILITY_API_KEYS", "")
+STABILITY_KEY_RATE = float(os.environ.get("STABILITY_KEY_RATE", "10"))
+STABILITY_KEY_BURST = float(os.environ.get("STABILITY_KEY_BURST", "10"))
+STABILITY_KEY_SELECTION = os.environ.get("STABILITY_KEY_SELECTION", "least_loaded")
+
+# 生成档位路由。GENERATION_TIERS 按质量从高到低排列，每项为 name=endpoint[:model]，
+# endpoint 是 .../v2beta/stable-image/generate/ 下的路径（sd3、ultra 等，需支持 image-to-image），model 为可选的 model 参数。
+# 每个任务出队时，选择在当前排队深度下预计仍能满足 GENERATION_SLO_SECONDS（p95）的最高质量档位；
+# 预计值来自各档位最近 ROUTING_WINDOW 次生成的服务耗时分位数（按画布尺寸分桶）。
+# GENERATION_FAST_QUEUE_DEPTH > 0 时，排队数达到该值直接使用最快的档位。
+GENERATION_TIERS = os.environ.get("GENERATION_TIERS", "quality=sd3:sd3.5-large,fast=sd3:sd3.5-large-turbo")
+GENERATION_SLO_SECONDS = float(os.environ.get("GENERATION_SLO_SECONDS", "30"))
+GENERATION_FAST_QUEUE_DEPTH = int(os.environ.get("GENERATION_FAST_QUEUE_DEPTH", "0"))
+ROUTING_WINDOW = int(os.environ.get("ROUTING_WINDOW", "200"))
+ROUTING_MIN_SAMPLES = int(os.environ.get("ROUTING_MIN_SAMPLES", "5"))
+ROUTING_MAX_AGE = float(os.environ.get("ROUTING_MAX_AGE", "600"))
+ROUTING_PINNED_KEYS = int(os.environ.get("ROUTING_PINNED_KEYS", "1024"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# 生成任务调度配置（全局并发上限、排队上限）
+# 每个生成任务都要占用一个出站请求名额（Liveblocks 请求走单独的客户端，不占用），并发上限不超过 HTTP_MAX_IN_FLIGHT
+GENERATION_MAX_CONCURRENCY = min(int(os.environ.get("GENERATION_MAX_CONCURRENCY", "4")), HTTP_MAX_IN_FLIGHT)
+GENERATION_MAX_QUEUE = int(os.environ.get("GENERATION_MAX_QUEUE", "64"))
+
+# 生成任务状态推送（保留的已结束任务数、每个订阅者的事件缓冲、SSE 保活间隔）
+JOB_HISTORY_SIZE = int(os.environ.get("JOB_HISTORY_SIZE", "1000"))
+JOB_EVENTS_BUFFER = int(os.environ.get("JOB_EVENTS_BUFFER", "256"))
+JOB_EVENTS_KEEPALIVE = float(os.environ.get("JOB_EVENTS_KEEPALIVE", "15"))
+
+# Gradio 队列配置。run_outpaint 只是把任务交给调度器后等待远端 API，
+# 所以 Gradio 的并发数要高于生成并发上限，让等待中的任务进入调度器按房间轮转；
+# Gradio 队列长度默认与调度器排队上限一致，状态推送间隔为 "auto" 或秒数。
+GRADIO_CONCURRENCY = int(os.environ.get("GRADIO_CONCURRENCY", str(GENERATION_MAX_CONCURRENCY * 2)))
+GRADIO_MAX_QUEUE = int(os.environ.get("GRADIO_MAX_QUEUE", str(GENERATION_MAX_QUEUE)))
+GRADIO_STATUS_UPDATE_RATE = os.environ.get("GRADIO_STATUS_UPDATE_RATE", "auto")
+if GRADIO_STATUS_UPDATE_RATE != "auto":
+    GRADIO_STATUS_UPDATE_RATE = float(GRADIO_STATUS_UPDATE_RATE)
+
+# 生成结果缓存配置（缓存目录、总大小上限，单位：字节）
+GENERATION_CACHE_PATH = Path(os.environ.get("GENERATION_CACHE_PATH", "cache/generation"))
+GENERATION_CACHE_MAX_BYTES = int(os.environ.get("GENERATION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# 缩略图（派生图）配置：允许的宽度档位、缓存目录和总大小上限
+DERIVATIVE_WIDTHS = sorted(int(w) for w in os.environ.get("DERIVATIVE_WIDTHS", "64,128,256,512,1024").split(","))
+DERIVATIVE_CACHE_PATH = Path(os.environ.get("DERIVATIVE_CACHE_PATH", "cache/derivatives"))
+DERIVATIVE_CACHE_MAX_BYTES = int(os.environ.get("DERIVATIVE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Stability API 返回的图片格式。SD3 端点只支持 png/jpeg；支持 webp 的端点设置为 webp 后，
+# 尺寸一致时可以直接落盘，省去解码和重新编码
+STABILITY_OUTPUT_FORMAT = os.environ.get("STABILITY_OUTPUT_FORMAT", "png")
+
+# 房间人数同步配置（并发查询上限、加入房间后单房间刷新的防抖时间，单位：秒）
+SYNC_ROOMS_CONCURRENCY = int(os.environ.get("SYNC_ROOMS_CONCURRENCY", "8"))
+SYNC_ROOM_DEBOUNCE = float(os.environ.get("SYNC_ROOM_DEBOUNCE", "2"))
+# 配置了 webhook 后，轮询只作为低频的对账兜底
+SYNC_ROOMS_INTERVAL = int(os.environ.get("SYNC_ROOMS_INTERVAL", "900" if LIVEBLOCKS_WEBHOOK_SECRET else "100"))
+WEBHOOK_TOLERANCE = int(os.environ.get("WEBHOOK_TOLERANCE", "300"))
+
+# 房间历史分页配置（默认/最大每页条数，流式输出时每批读取的条数）
+ROOM_DATA_PAGE_SIZE = int(os.environ.get("ROOM_DATA_PAGE_SIZE", "200"))
+ROOM_DATA_MAX_PAGE_SIZE = int(os.environ.get("ROOM_DATA_MAX_PAGE_SIZE", "1000"))
+ROOM_DATA_STREAM_BATCH = int(os.environ.get("ROOM_DATA_STREAM_BATCH", "500"))
+
+# 生成记录 write-behind 配置（攒够多少条或间隔多久批量写入一次，单位：秒）
+RECORDER_BATCH_SIZE = int(os.environ.get("RECORDER_BATCH_SIZE", "50"))
+RECORDER_FLUSH_INTERVAL = float(os.environ.get("RECORDER_FLUSH_INTERVAL", "1"))
+RECORDER_MAX_BUFFER = int(os.environ.get("RECORDER_MAX_BUFFER", "10000"))
+
+# SQLite 连接池大小（同时也是数据库专用线程数）
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+
+# 图片处理线程池大小，与 HTTP 并发上限分开配置
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
 # HF_TOKEN = os.environ.get("API_TOKEN") or True # huggingface_hub repo 可能仍需
 
 # --- 日志和路径配置 ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stdout)
-logger = logging.getLogger(__name__)
+# 日志记录在调用线程里只入队，格式化和写 stdout / 文件都在 QueueListener 的后台线程完成。
+# LOG_FORMAT=json 输出每行一个 JSON 对象；LOG_FILE 非空时额外写入轮转文件。
+# LOG_SAMPLE_RULES 按路径前缀对请求日志采样，例如 "/storage=0.01,/server/api/health=0"，5xx 响应总会记录。
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_FILE = os.environ.get("LOG_FILE", "")
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_FILE_BACKUPS = int(os.environ.get("LOG_FILE_BACKUPS", "3"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RULES = os.environ.get(
+    "LOG_SAMPLE_RULES", "/storage=0.01,/server/api/health=0,/metrics=0,/server/api/tiles=0.01"
+)
 
-from logging.handlers import RotatingFileHandler
 
-# 1. 定义日志文件的名称和路径
-# LOG_FILENAME = "app.log"
+class JSONFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON；消息里的 [Request ID: xxx] 会单独提取成字段"""
 
-# # 2. 创建一个全局的 logger
-# logger = logging.getLogger(__name__)
-# logger.setLevel(logging.INFO)
+    REQUEST_ID_PATTERN = re.compile(r'\[Request ID: (\w+)\]')
+    EXTRA_FIELDS = ("method", "path", "status", "duration_ms", "client")
 
-# # 3. 创建一个格式化器，定义日志的输出格式
-# formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": message,
+        }
+        match = self.REQUEST_ID_PATTERN.search(message)
+        if match:
+            entry["request_id"] = match.group(1)
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    只把记录放进内存队列，不在调用线程做格式化（同进程队列无需序列化）。
+    队列满时丢弃并计数，不阻塞事件循环。
+    """
 
-# # 4. 创建一个文件处理器 (FileHandler)，用于写入日志文件
-# #    使用 RotatingFileHandler 实现日志轮转，防止日志文件无限增大
-# #    maxBytes=5*1024*1024 表示单个文件最大5MB，backupCount=3 表示最多保留3个备份
-# file_handler = RotatingFileHandler(LOG_FILENAME, maxBytes=5*1024*1024, backupCount=3, encoding='utf-8')
-# file_handler.setFormatter(formatter)
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
 
-# # 5. 创建一个流处理器 (StreamHandler)，用于在控制台打印日志
-# stream_handler = logging.StreamHandler(sys.stdout)
-# stream_handler.setFormatter(formatter)
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
-# # 6. 为 logger 添加这两个处理器
-# logger.addHandler(file_handler)
-# logger.addHandler(stream_handler)
-# --- 日志配置结束 ---
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def background_handler(*handlers: logging.Handler) -> BackgroundQueueHandler:
+    """把若干同步 handler 包装成一个入队 handler，由独立的后台线程负责写出"""
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return BackgroundQueueHandler(log_queue)
+
+
+def parse_sample_rules(rules: str):
+    parsed = []
+    for rule in rules.split(","):
+        prefix, _, rate = rule.strip().partition("=")
+        if prefix and rate:
+            parsed.append((prefix, float(rate)))
+    # 最长前缀优先匹配
+    return sorted(parsed, key=lambda item: len(item[0]), reverse=True)
+
+
+def setup_logging() -> BackgroundQueueHandler:
+    formatter = JSONFormatter() if LOG_FORMAT == "json" else \
+        logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES,
+                                            backupCount=LOG_FILE_BACKUPS, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = background_handler(*handlers)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    return queue_handler
+
+
+log_queue_handler = setup_logging()
+log_sample_rules = parse_sample_rules(LOG_SAMPLE_RULES)
+logger = logging.getLogger(__name__)
 
 
 
@@ -79,6 +270,33 @@ LOCAL_STORAGE_PATH = Path("local_storage")
 GALLERY_PATH = LOCAL_STORAGE_PATH / "gallery"
 DEFAULT_BACKGROUND_IMAGE = "city.webp" 
 
+BLOB_PATH = LOCAL_STORAGE_PATH / "blobs"
+BLOB_GC_INTERVAL = int(os.environ.get("BLOB_GC_INTERVAL", "3600"))
+
+# 生成链路追踪：采样率（0~1）、内存中保留的最近 trace 数、可选的轮转 JSON 文件
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "200"))
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+TRACE_FILE_MAX_BYTES = int(os.environ.get("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", "3"))
+
+# /storage 静态文件：热点对象内存缓存（总大小上限、单个对象大小上限）
+STORAGE_HOT_CACHE_MAX_BYTES = int(os.environ.get("STORAGE_HOT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+STORAGE_HOT_OBJECT_MAX_BYTES = int(os.environ.get("STORAGE_HOT_OBJECT_MAX_BYTES", str(2 * 1024 * 1024)))
+STORAGE_CHUNK_SIZE = 256 * 1024
+
+# 延时动画导出配置（每段帧数、缓存目录和总大小上限）
+TIMELAPSE_SEGMENT_FRAMES = int(os.environ.get("TIMELAPSE_SEGMENT_FRAMES", "32"))
+TIMELAPSE_CACHE_PATH = Path(os.environ.get("TIMELAPSE_CACHE_PATH", "cache/timelapse"))
+TIMELAPSE_CACHE_MAX_BYTES = int(os.environ.get("TIMELAPSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# 房间瓦片金字塔配置（瓦片边长、层级数）
+TILES_PATH = LOCAL_STORAGE_PATH / "tiles"
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "256"))
+TILE_LEVELS = int(os.environ.get("TILE_LEVELS", "6"))
+# bootstrap composite 模式输出画布最长边的上限
+COMPOSITE_MAX_SIZE = int(os.environ.get("COMPOSITE_MAX_SIZE", "4096"))
+
 ROOM_DB = Path("rooms.db")
 ROOMS_DATA_DB = Path("rooms_data.db")  # 添加缺失的数据库定义
 
@@ -91,33 +309,421 @@ app = FastAPI()
 async def log_requests(request: Request, call_next):
     if "upgrade" in request.headers and request.headers["upgrade"] == "websocket":
         logger.info(f"!!! 收到 WebSocket 握手请求: {request.method} {request.url}")
-    else:
-        logger.info(f"收到 HTTP 请求: {request.method} {request.url}")
+        return await call_next(request)
+
+    path = request.url.path
+    rate = next((rate for prefix, rate in log_sample_rules if path.startswith(prefix)), 1.0)
+    start = time.perf_counter()
     response = await call_next(request)
+    if response.status_code >= 500 or (rate > 0 and (rate >= 1 or random.random() < rate)):
+        duration_ms = round((time.perf_counter() - start) * 1000, 2)
+        client = request.client.host if request.client else None
+        # 文本格式只渲染消息本身，字段要写进消息；JSON 格式另外把它们输出成独立字段
+        logger.info(
+            "HTTP 请求 %s %s %s %.1fms %s", request.method, path, response.status_code, duration_ms, client,
+            extra={
+                "method": request.method,
+                "path": path,
+                "status": response.status_code,
+                "duration_ms": duration_ms,
+                "client": client,
+            },
+        )
     return response
 
 # --- 您原有的所有辅助函数和API端点都应保留在这里 ---
 
-# 数据库连接函数
-def get_room_db():
-    db = sqlite3.connect(ROOM_DB, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    try:
-        yield db
-    except Exception:
-        db.rollback()
-    finally:
-        db.close()
+# --- Prometheus 指标 ---
+# 热路径上只做一次 bisect 和两次列表自增：每个标签组合的桶计数在首次出现时分配一次，之后不再分配；
+# 不加锁，图片线程里的并发自增在极少数情况下可能丢一次计数，对监控用途可以接受。
+# /metrics 被抓取时才把各桶累加成 Prometheus 文本格式。
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KB ~ 256MB
+
+
+def format_labels(labelnames, values, extra="") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series = {}  # 标签值 -> [各桶计数..., +Inf 桶计数, 总和]
+        if not self.labelnames:
+            self._series[()] = [0] * (len(self.buckets) + 2)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series.setdefault(labels, [0] * (len(self.buckets) + 2))
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}"
+
+
+class Gauge:
+    """抓取时调用 func 取当前值，热路径上没有任何开销"""
+
+    def __init__(self, name: str, documentation: str, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.func()}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                logger.error(f"采集指标 {metric.name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+GENERATION_TIER_LATENCY = metrics.register(Histogram(
+    "sd_generation_tier_seconds", "Generation service time (upstream call, retries, processing) by serving tier",
+    LATENCY_BUCKETS, ("tier",)))
+STABILITY_LATENCY = metrics.register(Histogram(
+    "sd_stability_request_seconds", "Stability API request latency by HTTP status", LATENCY_BUCKETS, ("status",)))
+IMAGE_STAGE_LATENCY = metrics.register(Histogram(
+    "sd_image_stage_seconds", "Image processing stage latency (decode/resize/encode)", LATENCY_BUCKETS, ("stage",)))
+UPLOAD_SIZE = metrics.register(Histogram("sd_upload_bytes", "Community upload sizes", SIZE_BUCKETS))
+SYNC_ROOMS_LATENCY = metrics.register(Histogram("sd_sync_rooms_seconds", "Full room presence sync duration", LATENCY_BUCKETS))
+SQLITE_LATENCY = metrics.register(Histogram(
+    "sd_sqlite_query_seconds", "SQLite query latency including pool wait", LATENCY_BUCKETS, ("db",)))
+
+
+# --- 链路追踪 ---
+# 以 Request ID 作为 trace id，在生成链路上记录嵌套的 span（排队、PNG 编码、上传到响应头、下载、缩放、WebP 编码、写盘）。
+# 当前 span 保存在 contextvar 里；未被采样的请求 contextvar 为空，span() 直接返回，几乎没有开销。
+# 完成的 trace 放进内存环形缓冲区，可通过 /server/api/debug/traces 查询，配置了 TRACE_FILE 时再按行写入轮转文件。
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "duration", "attrs", "spans")
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"] = None, **attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = shortuuid.uuid()[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.duration = None
+        self.attrs = attrs
+        # 同一个 trace 的所有 span 共用一个列表
+        self.spans = parent.spans if parent else []
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+            "attrs": self.attrs,
+        }
+
+
+class Tracer:
+    def __init__(self, sample_rate: float, buffer_size: int, file_path: str = "",
+                 file_max_bytes: int = 0, file_backups: int = 0):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=buffer_size)
+        self._file_logger = None
+        if file_path:
+            self._file_logger = logging.getLogger("sd.trace")
+            self._file_logger.propagate = False
+            self._file_logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(file_path, maxBytes=file_max_bytes, backupCount=file_backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._file_logger.addHandler(background_handler(handler))
+
+    @contextmanager
+    def trace(self, trace_id: str, name: str, **attrs):
+        """开始一个 trace（按采样率决定是否记录），yield 根 span，未采样时 yield None"""
+        if random.random() >= self.sample_rate:
+            yield None
+            return
+        root = Span(name, trace_id, **attrs)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except Exception as e:
+            root.set(error=type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(root)
+            self._export(root)
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attrs):
+        """在当前 span（或显式给出的 parent）下开一个子 span；没有活动的 trace 时什么也不做"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(name, parent.trace_id, parent, **attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+
+    def record(self, name: str, start: float, end: float, parent: Optional[Span] = None, **attrs):
+        """补记一段已经结束的区间，例如排队等待"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            return
+        span = Span(name, parent.trace_id, parent, **attrs)
+        span.start = start
+        self._finish(span, end - start)
+
+    @staticmethod
+    def _finish(span: Span, duration: Optional[float] = None):
+        span.duration = duration if duration is not None else time.time() - span.start
+        span.spans.append(span)
+
+    def _export(self, root: Span):
+        trace = {
+            "trace_id": root.trace_id,
+            "name": root.name,
+            "start": root.start,
+            "duration_ms": round(root.duration * 1000, 2),
+            "spans": [span.to_dict() for span in sorted(root.spans, key=lambda s: s.start)],
+        }
+        self.traces.append(trace)
+        if self._file_logger is not None:
+            self._file_logger.info(json.dumps(trace, ensure_ascii=False, default=str))
+
+    def find(self, trace_id: str) -> Optional[dict]:
+        return next((trace for trace in reversed(self.traces) if trace["trace_id"] == trace_id), None)
 
-def get_room_data_db():
-    db = sqlite3.connect(ROOMS_DATA_DB, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    try:
-        yield db
-    except Exception:
-        db.rollback()
-    finally:
-        db.close()
+
+tracer = Tracer(TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE, TRACE_FILE, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUPS)
+
+
+# --- SQLite 访问层 ---
+class SQLitePool:
+    """
+    SQLite 连接池。连接开启 WAL 和调优过的 pragma，并使用 sqlite3 自带的预编译语句缓存；
+    所有查询都在数据库专用线程池里执行，读写互不阻塞，也不占用事件循环。
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+    )
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"sqlite-{path.stem}")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256, timeout=5)
+        db.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        """同步取用一个连接（在数据库线程中使用）；异常时回滚"""
+        db = self._acquire()
+        try:
+            yield db
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            self._idle.put(db)
+
+    async def run(self, func, *args):
+        """在数据库线程池中执行 func(db, *args)"""
+        def task():
+            with self.connection() as db:
+                return func(db, *args)
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, task)
+        finally:
+            SQLITE_LATENCY.observe(time.perf_counter() - start, self.path.stem)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.run(lambda db: [dict(row) for row in db.execute(sql, params).fetchall()])
+
+    async def execute(self, sql: str, params=()):
+        def task(db):
+            with db:
+                return db.execute(sql, params).rowcount
+        return await self.run(task)
+
+    async def executemany(self, sql: str, seq_of_params):
+        def task(db):
+            with db:
+                return db.executemany(sql, seq_of_params).rowcount
+        return await self.run(task)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+room_db = SQLitePool(ROOM_DB, DB_POOL_SIZE)
+room_data_db = SQLitePool(ROOMS_DATA_DB, DB_POOL_SIZE)
+
+
+class FrameRecorder:
+    """
+    生成记录的 write-behind 写入器。
+    每次生成完成只把元数据放进内存缓冲区，后台任务在攒够 batch_size 条或等待满 flush_interval 秒后
+    在一个事务里批量写入 rooms_data，请求本身不承担提交延迟；关闭时把剩余记录全部写完。
+    """
+
+    INSERT_SQL = "INSERT INTO rooms_data (room_id, key, prompt, time, x, y) VALUES (?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, pool: SQLitePool, batch_size: int, flush_interval: float, max_buffer: int):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._wakeup = None
+        self._task = None
+
+    def record(self, room_id: str, key: str, prompt: str, timestamp: int, x: int, y: int):
+        self._buffer.append((room_id, key, prompt, timestamp, x, y))
+        if len(self._buffer) > self.max_buffer:
+            # 数据库长时间不可用时丢弃最旧的记录，避免内存无限增长
+            dropped = len(self._buffer) - self.max_buffer
+            del self._buffer[:dropped]
+            logger.error(f"生成记录缓冲区已满，丢弃了 {dropped} 条最旧的记录。")
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return 0
+        rows, self._buffer = self._buffer, []
+        try:
+            await self.pool.executemany(self.INSERT_SQL, rows)
+        except Exception as e:
+            logger.error(f"生成记录写入 rooms_data 失败，稍后重试: {e}")
+            self._buffer[:0] = rows
+            return 0
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        written = await self.flush()
+        if written:
+            logger.info(f"关闭前写入了 {written} 条生成记录。")
+
+
+frame_recorder = FrameRecorder(room_data_db, RECORDER_BATCH_SIZE, RECORDER_FLUSH_INTERVAL, RECORDER_MAX_BUFFER)
+
+
+@app.on_event("startup")
+async def start_frame_recorder():
+    frame_recorder.start()
+
+
+# 必须先于 close_databases 注册，保证关闭时缓冲区在连接池关闭前写完
+@app.on_event("shutdown")
+async def stop_frame_recorder():
+    await frame_recorder.stop()
+
+
+@app.on_event("shutdown")
+async def close_databases():
+    room_db.close()
+    room_data_db.close()
 
 # slugify 工具函数
 def slugify(value):
@@ -125,10 +731,891 @@ def slugify(value):
     out = re.sub(r'[-\s]+', '-', value)
     return out[:400]
 
+# --- 共享的异步出站 HTTP 客户端 ---
+class OutboundHTTPClient:
+    """
+    所有对外 HTTP 调用共用的异步客户端。
+    复用 keep-alive 连接池，用信号量限制同时在途的请求数，并支持按调用覆盖连接/读取超时。
+    """
+
+    def __init__(self, max_connections: int, max_keepalive: int, max_in_flight: int,
+                 connect_timeout: float, read_timeout: float):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # 延迟创建，保证客户端绑定在 uvicorn 的事件循环上
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            )
+        return self._client
+
+    async def request(self, method: str, url: str, connect_timeout: float = None,
+                      read_timeout: float = None, **kwargs) -> httpx.Response:
+        timeout = httpx.Timeout(
+            read_timeout or self.read_timeout,
+            connect=connect_timeout or self.connect_timeout,
+        )
+        with tracer.span("http.request", method=method, url=url) as span:
+            if span is None:
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        return await self._get_client().request(method, url, timeout=timeout, **kwargs)
+                    finally:
+                        self.in_flight -= 1
+
+            # 被采样时分开记录：等待并发名额、发送请求到收到响应头（上传 + 模型处理）、下载响应体
+            with tracer.span("http.wait_slot"):
+                await self._semaphore.acquire()
+            self.in_flight += 1
+            try:
+                client = self._get_client()
+                with tracer.span("http.send_until_headers"):
+                    response = await client.send(
+                        client.build_request(method, url, timeout=timeout, **kwargs), stream=True
+                    )
+                span.set(status=response.status_code)
+                with tracer.span("http.download") as download:
+                    try:
+                        await response.aread()
+                    finally:
+                        await response.aclose()
+                    download.set(bytes=len(response.content))
+                return response
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+http_client = OutboundHTTPClient(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive=HTTP_MAX_KEEPALIVE,
+    max_in_flight=HTTP_MAX_IN_FLIGHT,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+)
+liveblocks_client = OutboundHTTPClient(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive=HTTP_MAX_KEEPALIVE,
+    max_in_flight=LIVEBLOCKS_MAX_IN_FLIGHT,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+)
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+    await liveblocks_client.aclose()
+
+
+# --- 生成任务调度器 ---
+class QueueFullError(Exception):
+    """生成队列已满，拒绝新的任务"""
+
+
+class GenerationJob:
+    def __init__(self, job_id: str, room_id: str, func):
+        self.job_id = job_id
+        self.room_id = room_id
+        self.func = func
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.time()) - self.enqueued_at
+
+
+class GenerationScheduler:
+    """
+    有界的生成任务队列。
+    每个 room_id 一条子队列，按房间轮询出队，保证繁忙的房间不会饿死其他房间；
+    同时运行的任务数受全局并发上限约束，排队总数超过上限时直接拒绝。
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.depth = 0
+        self._queues = {}
+        self._rooms = deque()
+        self._running = {}
+        self._tasks = set()  # 正在执行的 asyncio.Task，保留强引用以免运行中被垃圾回收
+        # 队列变化（入队、出队、完成）后的回调，用于推送排队位置
+        self.on_change = None
+
+    async def submit(self, job_id: str, room_id: str, func):
+        """提交任务并等待其结果；func 是返回协程的无参函数"""
+        if self.depth >= self.max_queue:
+            raise QueueFullError(f"生成队列已满 ({self.depth}/{self.max_queue})")
+
+        job = GenerationJob(job_id, room_id, func)
+        if room_id not in self._queues:
+            self._queues[room_id] = deque()
+            self._rooms.append(room_id)
+        self._queues[room_id].append(job)
+        self.depth += 1
+        self._dispatch()
+        self._notify()
+
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # 调用方放弃等待：还在排队的任务在出队时会被跳过
+            job.future.cancel()
+            raise
+
+    def _next_job(self):
+        while self._rooms:
+            room_id = self._rooms.popleft()
+            queue = self._queues[room_id]
+            job = queue.popleft()
+            self.depth -= 1
+            if queue:
+                self._rooms.append(room_id)
+            else:
+                del self._queues[room_id]
+            if not job.future.cancelled():
+                return job
+        return None
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started_at = time.time()
+            self.active += 1
+            self._running[job.job_id] = job
+            task = asyncio.ensure_future(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: GenerationJob):
+        try:
+            result = await job.func()
+            if not job.future.done():
+                job.future.set_result(result)
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.active -= 1
+            self._running.pop(job.job_id, None)
+            self._dispatch()
+            self._notify()
+
+    def _notify(self):
+        if self.on_change is not None:
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error(f"生成队列回调出错: {e}")
+
+    def positions(self) -> Dict[str, int]:
+        """所有排队任务的预计出队位置"""
+        return {job.job_id: index + 1 for index, job in enumerate(self._iter_queued())}
+
+    def position(self, job_id: str):
+        """任务在轮询顺序下的预计出队位置（从 1 开始），不在队列中时返回 None"""
+        for index, job in enumerate(self._iter_queued()):
+            if job.job_id == job_id:
+                return index + 1
+        return None
+
+    def _iter_queued(self):
+        # 模拟轮询出队顺序
+        queues = [list(self._queues[room_id]) for room_id in self._rooms]
+        depth = max((len(q) for q in queues), default=0)
+        for i in range(depth):
+            for queue in queues:
+                if i < len(queue) and not queue[i].future.cancelled():
+                    yield queue[i]
+
+    def snapshot(self):
+        return {
+            "active": self.active,
+            "queued": self.depth,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "running": [
+                {"job_id": job.job_id, "room_id": job.room_id, "wait_time": round(job.wait_time, 3),
+                 "run_time": round(time.time() - job.started_at, 3)}
+                for job in self._running.values()
+            ],
+            "queue": [
+                {"job_id": job.job_id, "room_id": job.room_id, "position": index + 1,
+                 "wait_time": round(job.wait_time, 3)}
+                for index, job in enumerate(self._iter_queued())
+            ],
+        }
+
+
+generation_scheduler = GenerationScheduler(
+    max_concurrency=GENERATION_MAX_CONCURRENCY,
+    max_queue=GENERATION_MAX_QUEUE,
+)
+
+
+# 生成任务状态推送
+# 通过 /server/api/generation/jobs 提交的任务登记在这里，状态变化（queued、position、started、
+# calling_api、encoding、done、error）按房间推送给 /server/api/rooms/{room_id}/jobs/events 的 SSE 订阅者。
+# 订阅者的队列写满（客户端读得太慢）时断开该连接，客户端重连后会先收到当前任务快照。
+class JobSubscriber:
+    __slots__ = ("queue", "overflowed")
+
+    def __init__(self, buffer_size: int):
+        self.queue = asyncio.Queue(buffer_size)
+        self.overflowed = False
+
+
+class JobEvents:
+    TERMINAL_STATES = ("done", "error")
+
+    def __init__(self, scheduler: GenerationScheduler, history_size: int, subscriber_buffer: int):
+        self.scheduler = scheduler
+        self.history_size = history_size
+        self.subscriber_buffer = subscriber_buffer
+        self.jobs = OrderedDict()  # job_id -> 最新状态
+        self.tasks = {}  # job_id -> 正在执行的 asyncio.Task，保留强引用以免运行中被垃圾回收
+        self._subscribers = {}  # room_id -> set(asyncio.Queue)
+        scheduler.on_change = self.refresh_positions
+
+    def create(self, job_id: str, room_id: str, image_key: str) -> dict:
+        job = {"job_id": job_id, "room_id": room_id, "image_key": image_key, "state": "queued",
+               "position": None, "created_at": time.time()}
+        self.jobs[job_id] = job
+        # 只淘汰已结束的旧任务
+        while len(self.jobs) > self.history_size:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest["state"] not in self.TERMINAL_STATES:
+                break
+            del self.jobs[oldest_id]
+        self.publish(room_id, job)
+        return job
+
+    def start(self, job_id: str, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+        return task
+
+    def update(self, job_id: str, state: str, **fields):
+        """更新任务状态并推送；不是通过任务 API 提交的请求（例如 Gradio）没有登记，直接忽略"""
+        job = self.jobs.get(job_id)
+        if job is None or job["state"] in self.TERMINAL_STATES:
+            return
+        job.update(fields, state=state, updated_at=time.time())
+        self.publish(job["room_id"], job)
+
+    def refresh_positions(self):
+        if not self.jobs:
+            return
+        for job_id, position in self.scheduler.positions().items():
+            job = self.jobs.get(job_id)
+            if job is not None and job["state"] in ("queued", "position") and job["position"] != position:
+                self.update(job_id, "position", position=position)
+
+    def publish(self, room_id: str, job: dict):
+        event = dict(job)
+        for subscriber in list(self._subscribers.get(room_id, ())):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+
+    def room_jobs(self, room_id: str):
+        return [dict(job) for job in self.jobs.values() if job["room_id"] == room_id]
+
+    async def subscribe(self, room_id: str):
+        """逐个产出该房间的任务事件；先产出当前快照"""
+        subscriber = JobSubscriber(self.subscriber_buffer)
+        self._subscribers.setdefault(room_id, set()).add(subscriber)
+        try:
+            for job in self.room_jobs(room_id):
+                yield job
+            while not subscriber.overflowed:
+                try:
+                    yield await asyncio.wait_for(subscriber.queue.get(), JOB_EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            subscribers = self._subscribers.get(room_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[room_id]
+
+
+job_events = JobEvents(generation_scheduler, JOB_HISTORY_SIZE, JOB_EVENTS_BUFFER)
+
+
+# --- 磁盘缓存（生成结果、缩略图共用） ---
+class DiskCache:
+    """
+    按内容寻址的 WebP 磁盘缓存，按总大小做 LRU 淘汰。
+    相同键的并发请求只执行一次 producer，所有等待者共享结果。
+    图生图结果的键由 (prompt, strength, mode, 输入图哈希, 目标尺寸) 计算，文生图不缓存。
+    条目可以附带一份 JSON 元数据（例如产出结果的档位），与 WebP 存在同一目录、一起淘汰。
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        payload = json.dumps(parts)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.webp"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def _load(self):
+        # 启动后第一次访问时扫描磁盘，按修改时间恢复 LRU 顺序
+        if self._loaded:
+            return
+        self._loaded = True
+        files = sorted(self.root.glob("*/*.webp"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._entries[path.stem] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            for path in (self._path(key), self._meta_path(key)):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _read(self, key: str):
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                self.total_bytes -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+            os.utime(path)
+            return data
+
+    def _write(self, key: str, data: bytes, meta: Optional[dict] = None):
+        with self._lock:
+            self._load()
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 先写元数据：WebP 一旦可见就可能被命中，此时元数据必须已经就位
+            meta_path = self._meta_path(key)
+            if meta is not None:
+                meta_path.write_text(json.dumps(meta))
+            else:
+                meta_path.unlink(missing_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def meta(self, key: str) -> dict:
+        """条目写入时附带的元数据；没有元数据或条目已被淘汰时返回空字典"""
+        with self._lock:
+            try:
+                return json.loads(self._meta_path(key).read_text())
+            except (FileNotFoundError, ValueError):
+                return {}
+
+    async def get_or_create(self, key: str, producer, meta: Optional[dict] = None):
+        """
+        返回 (WebP 字节, 是否复用了已有结果)；producer 是产出 WebP 字节的无参协程函数，
+        meta 只在本次调用真正执行了 producer 时随结果写入
+        """
+        data = await asyncio.to_thread(self._read, key)
+        if data is not None:
+            return data, True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight), True
+
+        future = asyncio.get_running_loop().create_future()
+        # 没有其他等待者时也要取走异常，避免 "exception was never retrieved" 警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            data = await producer()
+            future.set_result(data)
+            # 写盘完成之前一直保留在途记录，否则这段时间里到达的相同请求既找不到在途任务也读不到缓存
+            try:
+                await asyncio.to_thread(self._write, key, data, meta)
+            except OSError as e:
+                logger.warning(f"写入缓存失败: {e}")
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+        return data, False
+
+
+generation_cache = DiskCache(GENERATION_CACHE_PATH, GENERATION_CACHE_MAX_BYTES)
+derivative_cache = DiskCache(DERIVATIVE_CACHE_PATH, DERIVATIVE_CACHE_MAX_BYTES)
+timelapse_cache = DiskCache(TIMELAPSE_CACHE_PATH, TIMELAPSE_CACHE_MAX_BYTES)
+
+
+# --- 图片处理线程池 ---
+# Pillow 的解码、缩放、编码和统计运算在执行期间会释放 GIL，
+# 放到线程池里即可与事件循环并行，且不需要在进程间序列化整张图片。
+try:
+    RESAMPLING_FILTER = Image.Resampling.LANCZOS
+except AttributeError: # 兼容旧版 Pillow
+    RESAMPLING_FILTER = Image.LANCZOS
+
+
+def is_blank_canvas(image: Image.Image, threshold: float = 10, sample_size: int = 128) -> bool:
+    """在缩小后的视图上估算 RGB 标准差，不为整张画布分配数组"""
+    sample = image
+    if max(image.size) > sample_size:
+        scale = sample_size / max(image.size)
+        sample_dims = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        # 最近邻采样保留原始像素值的分布，缩小均值滤波则会压低标准差
+        sample = image.resize(sample_dims, Image.NEAREST)
+    if sample.mode != "RGB":
+        sample = sample.convert("RGB")
+    stat = ImageStat.Stat(sample)
+    count = sum(stat.count)
+    mean = sum(stat.sum) / count
+    variance = max(sum(stat.sum2) / count - mean * mean, 0.0)
+    return variance ** 0.5 < threshold
+
+
+def image_digest(image: Image.Image) -> str:
+    return hashlib.sha256(image.tobytes()).hexdigest()
+
+
+def encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    # 只用于上传给 API，低压缩级别换取远低于默认级别的编码耗时
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def decode_image(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def resize_image(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    return image.resize(size, RESAMPLING_FILTER)
+
+
+def encode_webp(image: Image.Image) -> bytes:
+    if image.mode != "RGB":
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP")
+    return buffer.getvalue()
+
+
+def render_derivative(path: Path, width: int, quality: int) -> bytes:
+    with Image.open(path) as image:
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            # draft 让 JPEG 在解码阶段直接缩小；reducing_gap 先整数倍缩小再精细缩放
+            image.draft("RGB", (width, height))
+            image = image.resize((width, height), RESAMPLING_FILTER, reducing_gap=2.0)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="WEBP", quality=quality)
+        return buffer.getvalue()
+
+
+class ImageProcessor:
+    """
+    在独立线程池中执行 CPU 密集的图片处理阶段，并统计每个阶段的耗时。
+    传入 timings 字典时，本次调用的阶段耗时（秒）也会写进去，便于按请求输出。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-worker")
+        self.stage_stats: Dict[str, Dict[str, float]] = {}
+
+    async def run(self, stage: str, func, *args, timings: Optional[Dict[str, float]] = None):
+        def timed():
+            start = time.perf_counter()
+            result = func(*args)
+            return result, time.perf_counter() - start
+
+        with tracer.span(f"image.{stage}"):
+            result, elapsed = await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        stats = self.stage_stats.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["count"] += 1
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        IMAGE_STAGE_LATENCY.observe(elapsed, stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+        return result
+
+    async def is_blank(self, image: Image.Image, timings: Optional[Dict[str, float]] = None) -> bool:
+        return await self.run("blank_check", is_blank_canvas, image, timings=timings)
+
+    async def digest(self, image: Image.Image, timings: Optional[Dict[str, float]] = None) -> str:
+        return await self.run("digest", image_digest, image, timings=timings)
+
+    async def encode_png(self, image: Image.Image, timings: Optional[Dict[str, float]] = None) -> bytes:
+        return await self.run("encode_png", encode_png, image, timings=timings)
+
+    async def decode(self, data: bytes, timings: Optional[Dict[str, float]] = None) -> Image.Image:
+        return await self.run("decode", decode_image, data, timings=timings)
+
+    async def resize(self, image: Image.Image, size: Tuple[int, int],
+                     timings: Optional[Dict[str, float]] = None) -> Image.Image:
+        return await self.run("resize", resize_image, image, size, timings=timings)
+
+    async def encode_webp(self, image: Image.Image, timings: Optional[Dict[str, float]] = None) -> bytes:
+        return await self.run("encode_webp", encode_webp, image, timings=timings)
+
+    async def derivative(self, path: Path, width: int, quality: int,
+                         timings: Optional[Dict[str, float]] = None) -> bytes:
+        return await self.run("derivative", render_derivative, path, width, quality, timings=timings)
+
+    def snapshot(self):
+        return {
+            "workers": self.max_workers,
+            "stages": {
+                stage: {
+                    "count": stats["count"],
+                    "avg_seconds": round(stats["total_seconds"] / stats["count"], 4),
+                    "max_seconds": round(stats["max_seconds"], 4),
+                }
+                for stage, stats in self.stage_stats.items()
+            },
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+image_processor = ImageProcessor(IMAGE_WORKERS)
+
+
+@app.on_event("shutdown")
+async def shutdown_image_processor():
+    image_processor.shutdown()
+
+
+# --- 内容寻址的文件存储 ---
+class BlobStore:
+    """
+    按内容哈希存储文件，每份内容在磁盘上只保存一次：
+    blobs/ab/cd/<sha256>.webp，房间目录和 timelapse 目录下的文件都是指向它的硬链接，
+    因此 /storage/... 的原有 URL 不变。引用计数直接使用文件系统的链接数，
+    链接数为 1（只剩 blob 自身）时即可回收。
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        # store（写 blob + 建链接）与 GC 的"检查链接数 + 删除"互斥，
+        # 否则 GC 可能在 put 确认 blob 存在之后、建立链接之前把它删掉
+        self._lock = threading.Lock()
+
+    def path_for(self, digest: str, suffix: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / f"{digest}{suffix}"
+
+    def put(self, data: bytes, suffix: str = ".webp") -> Path:
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.path_for(digest, suffix)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.with_name(f"{blob_path.name}.{shortuuid.uuid()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, blob_path)
+        return blob_path
+
+    def link(self, blob_path: Path, dest: Path):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(blob_path, dest)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            # 不支持硬链接的文件系统（或跨设备）退化为复制
+            logger.warning(f"无法创建硬链接 {dest}，改为复制: {e}")
+            shutil.copyfile(blob_path, dest)
+
+    def store(self, data: bytes, *dests: Path, suffix: str = ".webp") -> Path:
+        with self._lock:
+            blob_path = self.put(data, suffix)
+            for dest in dests:
+                self.link(blob_path, dest)
+        return blob_path
+
+    @staticmethod
+    def refcount(blob_path: Path) -> int:
+        return blob_path.stat().st_nlink - 1
+
+    def collect_garbage(self):
+        """删除没有任何引用的 blob，返回 (删除数量, 释放字节数)"""
+        removed, freed = 0, 0
+        for blob_path in self.root.glob("*/*/*"):
+            try:
+                if blob_path.name.endswith(".tmp"):
+                    # 写入中途崩溃留下的临时文件
+                    if time.time() - blob_path.stat().st_mtime < 3600:
+                        continue
+                    size = blob_path.stat().st_size
+                    blob_path.unlink()
+                else:
+                    with self._lock:
+                        if self.refcount(blob_path) > 0:
+                            continue
+                        size = blob_path.stat().st_size
+                        blob_path.unlink()
+                removed += 1
+                freed += size
+            except FileNotFoundError:
+                continue
+        return removed, freed
+
+
+blob_store = BlobStore(BLOB_PATH)
+
+
+@app.on_event("startup")
+@repeat_every(seconds=BLOB_GC_INTERVAL, wait_first=True)
+async def gc_blobs():
+    removed, freed = await asyncio.to_thread(blob_store.collect_garbage)
+    if removed:
+        logger.info(f"已回收 {removed} 个无引用的 blob，释放 {freed / 1024 / 1024:.1f} MB。")
+
+
+# --- 房间瓦片金字塔 ---
+class TilePyramid:
+    """
+    每个房间一套固定边长的瓦片金字塔：tiles/{room_id}/{z}/{x}_{y}.webp。
+    第 0 层是原始分辨率，第 z 层每个瓦片覆盖 tile_size * 2^z 的画布区域。
+    新的画框只会重绘它覆盖到的瓦片：第 0 层把画框直接贴到已有瓦片上（后来的画框在上层），
+    上层瓦片由下一层的 4 个子瓦片缩小拼合。第 0 层使用无损编码，避免反复贴图累积压缩损失。
+    从未构建过的房间在第一次访问时按 rooms_data 的时间顺序重放全部历史。
+    """
+
+    def __init__(self, root: Path, tile_size: int, levels: int):
+        self.root = root
+        self.tile_size = tile_size
+        self.levels = levels
+        # 房间 -> 锁；弱引用，没有协程持有或等待时自动释放，不会随访问过的房间数增长
+        self._locks = weakref.WeakValueDictionary()
+        self._tasks = set()  # 后台的增量更新任务，保留强引用以免运行中被垃圾回收
+        self._pending = {}  # 房间 -> 尚未完成的增量更新数
+        self._replayed = {}  # 房间 -> 有增量更新在等待时，最近一次完整构建重放过的画框文件名
+
+    def tile_path(self, room_id: str, z: int, tx: int, ty: int) -> Path:
+        return self.root / room_id / str(z) / f"{tx}_{ty}.webp"
+
+    def _manifest_path(self, room_id: str) -> Path:
+        return self.root / room_id / "manifest.json"
+
+    def read_manifest(self, room_id: str):
+        try:
+            return json.loads(self._manifest_path(room_id).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_manifest(self, room_id: str, manifest):
+        path = self._manifest_path(room_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, path)
+
+    def _load_tile(self, path: Path):
+        try:
+            with Image.open(path) as tile:
+                return tile.convert("RGBA")
+        except FileNotFoundError:
+            return None
+
+    def _save_tile(self, tile: Image.Image, path: Path, lossless: bool):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        if lossless:
+            tile.save(tmp_path, format="WEBP", lossless=True, method=1)
+        else:
+            tile.save(tmp_path, format="WEBP", quality=90)
+        os.replace(tmp_path, path)
+
+    def _tile_range(self, start: int, end: int, span: int):
+        return range(start // span, (end - 1) // span + 1)
+
+    def _render_parent(self, room_id: str, z: int, tx: int, ty: int):
+        half = self.tile_size // 2
+        tile = Image.new("RGBA", (self.tile_size, self.tile_size))
+        for dy in (0, 1):
+            for dx in (0, 1):
+                child = self._load_tile(self.tile_path(room_id, z - 1, 2 * tx + dx, 2 * ty + dy))
+                if child is not None:
+                    tile.paste(child.reduce(2), (dx * half, dy * half))
+        self._save_tile(tile, self.tile_path(room_id, z, tx, ty), lossless=False)
+
+    def apply_frame(self, room_id: str, frame_path: Path, x: int, y: int, manifest=None):
+        """把一个画框贴进金字塔（同步，在图片线程池中执行），返回更新后的 manifest"""
+        with Image.open(frame_path) as frame:
+            frame = frame.convert("RGBA")
+        width, height = frame.size
+        size = self.tile_size
+
+        for ty in self._tile_range(y, y + height, size):
+            for tx in self._tile_range(x, x + width, size):
+                path = self.tile_path(room_id, 0, tx, ty)
+                tile = self._load_tile(path) or Image.new("RGBA", (size, size))
+                tile.paste(frame, (x - tx * size, y - ty * size))
+                self._save_tile(tile, path, lossless=True)
+
+        for z in range(1, self.levels):
+            span = size * 2 ** z
+            for ty in self._tile_range(y, y + height, span):
+                for tx in self._tile_range(x, x + width, span):
+                    self._render_parent(room_id, z, tx, ty)
+
+        manifest = manifest or self.read_manifest(room_id) or self._empty_manifest()
+        bounds = manifest["bounds"]
+        manifest["bounds"] = [x, y, x + width, y + height] if bounds is None else [
+            min(bounds[0], x), min(bounds[1], y), max(bounds[2], x + width), max(bounds[3], y + height)
+        ]
+        manifest["frames"] += 1
+        manifest["updated"] = time.time()
+        return manifest
+
+    def _empty_manifest(self):
+        return {"tile_size": self.tile_size, "levels": self.levels, "frames": 0, "bounds": None, "updated": None}
+
+    def _lock(self, room_id: str) -> asyncio.Lock:
+        lock = self._locks.get(room_id)
+        if lock is None:
+            lock = self._locks[room_id] = asyncio.Lock()
+        return lock
+
+    def schedule_frame(self, room_id: str, frame_path: Path, x: int, y: int):
+        """
+        新画框落盘并记入 frame_recorder 后同步调用，在后台执行增量更新。
+        计数在这里同步登记，之后开始的完整构建就知道有更新在等锁，会记下自己重放过的画框。
+        """
+        self._pending[room_id] = self._pending.get(room_id, 0) + 1
+        task = asyncio.ensure_future(self.add_frame(room_id, frame_path, x, y))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def add_frame(self, room_id: str, frame_path: Path, x: int, y: int):
+        """只重绘新画框覆盖的瓦片；房间尚未构建时留给首次访问时的完整重放"""
+        try:
+            async with self._lock(room_id):
+                manifest = self.read_manifest(room_id)
+                # 等锁期间完成的完整构建可能已经重放过这个画框，再贴一次会盖住比它新的画框
+                if manifest is None or frame_path.name in self._replayed.get(room_id, ()):
+                    return
+                manifest = await image_processor.run("tiles", self.apply_frame, room_id, frame_path, x, y, manifest)
+                self._write_manifest(room_id, manifest)
+        except Exception as e:
+            logger.error(f"更新房间 '{room_id}' 的瓦片失败: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            self._pending[room_id] -= 1
+            if not self._pending[room_id]:
+                del self._pending[room_id]
+                self._replayed.pop(room_id, None)
+
+    async def ensure_built(self, room_id: str):
+        manifest = self.read_manifest(room_id)
+        if manifest is not None:
+            return manifest
+        async with self._lock(room_id):
+            manifest = self.read_manifest(room_id)
+            if manifest is not None:
+                return manifest
+
+            logger.info(f"正在为房间 '{room_id}' 构建瓦片金字塔...")
+            start_time = time.time()
+            # 先把 write-behind 缓冲区写完，保证重放能看到刚生成的画框
+            await frame_recorder.flush()
+            await asyncio.to_thread(shutil.rmtree, self.root / room_id, True)
+            manifest = self._empty_manifest()
+            replayed = set()
+            after = None
+            while True:
+                rows = await fetch_room_history(room_id, after=after, limit=ROOM_DATA_STREAM_BATCH)
+                for row in rows:
+                    frame_path = LOCAL_STORAGE_PATH / room_id / str(row["key"])
+                    replayed.add(frame_path.name)
+                    if frame_path.is_file():
+                        manifest = await image_processor.run(
+                            "tiles", self.apply_frame, room_id, frame_path, int(row["x"]), int(row["y"]), manifest
+                        )
+                if len(rows) < ROOM_DATA_STREAM_BATCH:
+                    break
+                after = (rows[-1]["time"], rows[-1]["_rowid"])
+            manifest["updated"] = manifest["updated"] or time.time()
+            self._write_manifest(room_id, manifest)
+            if self._pending.get(room_id):
+                self._replayed[room_id] = replayed
+            logger.info(f"房间 '{room_id}' 瓦片构建完成，共 {manifest['frames']} 个画框，耗时 {time.time() - start_time:.2f} 秒。")
+            return manifest
+
+
+tile_pyramid = TilePyramid(TILES_PATH, TILE_SIZE, TILE_LEVELS)
+
+
 # liveblocks 房间用户数获取
-def get_room_count(room_id: str):
+async def get_room_count(room_id: str):
     try:
-        response = requests.get(
+        response = await liveblocks_client.get(
             f"https://api.liveblocks.io/v2/rooms/{room_id}/active_users",
             headers={
                 "Authorization": f"Bearer {LIVEBLOCKS_SECRET}", 
@@ -145,63 +1632,233 @@ def get_room_count(room_id: str):
                 f"获取房间 '{room_id}' 用户数失败。状态码: {response.status_code}, 原因: {response.text}"
             )
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         raise Exception(f"请求 Liveblocks API 时发生网络错误: {e}")
 
 
 # 定时任务
 @app.on_event("startup")
-@repeat_every(seconds=100)
-def sync_rooms():
-    logger.info("Syncing rooms active users")
+@repeat_every(seconds=SYNC_ROOMS_INTERVAL)
+async def sync_rooms():
+    await sync_rooms_once()
+
+
+async def sync_rooms_once():
+    start = time.perf_counter()
     try:
-        for db in get_room_db():
-            cursor = db.cursor()
-            rooms = cursor.execute("SELECT * FROM rooms").fetchall()
-            
-            for row in rooms:
-                room_id = row["room_id"]
+        await room_presence.sync_all()
+    finally:
+        SYNC_ROOMS_LATENCY.observe(time.perf_counter() - start)
+
+
+class RoomPresenceSync:
+    """
+    Liveblocks 房间人数同步。
+    全量同步时按并发上限同时查询所有房间，只把人数有变化的房间在一个事务里批量写回；
+    用户加入房间时只对该房间做一次防抖后的单独刷新。
+    """
+
+    def __init__(self, concurrency: int, debounce: float):
+        self.concurrency = concurrency
+        self.debounce = debounce
+        self.counts = {}
+        self._pending = {}
+
+    async def _fetch_counts(self, room_ids):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(room_id):
+            async with semaphore:
                 try:
-                    users_count = get_room_count(room_id)
-                    
-                    cursor.execute(
-                        "UPDATE rooms SET users_count = ? WHERE room_id = ?", 
-                        (users_count, room_id)
-                    )
+                    return room_id, await get_room_count(room_id)
                 except Exception as e:
                     if "404" in str(e):
-                        pass
                         logger.warning(f"警告：房间 '{room_id}' 在 Liveblocks 上未找到，将跳过此房间。")
                     else:
                         logger.error(f"处理房间 '{room_id}' 时发生严重错误，请检查: {e}")
-            
-            db.commit()
-            logger.info("房间同步任务完成！")
+                    return room_id, None
+
+        results = await asyncio.gather(*(fetch(room_id) for room_id in room_ids))
+        return {room_id: count for room_id, count in results if count is not None}
+
+    async def _write_changes(self, current, counts):
+        changes = [
+            (users_count, room_id)
+            for room_id, users_count in counts.items()
+            if current.get(room_id) != users_count
+        ]
+        self.counts.update(counts)
+        if not changes:
+            return 0
+        await room_db.executemany("UPDATE rooms SET users_count = ? WHERE room_id = ?", changes)
+        return len(changes)
+
+    async def apply_event(self, room_id: str, delta: int, active_users: int = None):
+        """
+        根据 webhook 事件增量更新房间人数。
+        事件带有 numActiveUsers 时以它为准，否则在内存计数上加减 delta。
+        """
+        current = self.counts.get(room_id)
+        if current is None:
+            current = (await self._current_counts(room_id)).get(room_id)
+            if current is None:
+                logger.warning(f"webhook 事件中的房间 '{room_id}' 不在数据库中，忽略。")
+                return None
+        users_count = active_users if active_users is not None else max(current + delta, 0)
+        await self._write_changes({room_id: current}, {room_id: users_count})
+        return users_count
+
+    async def _current_counts(self, room_id: str = None):
+        if room_id is None:
+            rows = await room_db.fetchall("SELECT room_id, users_count FROM rooms")
+        else:
+            rows = await room_db.fetchall(
+                "SELECT room_id, users_count FROM rooms WHERE room_id = ?", (room_id,)
+            )
+        return {row["room_id"]: row["users_count"] for row in rows}
 
-    except Exception as e:
-        logger.error(f"发生数据库级别错误: {e}")
-        logger.error(traceback.format_exc())
+    async def sync_all(self):
+        logger.info("Syncing rooms active users")
+        try:
+            current = await self._current_counts()
+            counts = await self._fetch_counts(list(current))
+            changed = await self._write_changes(current, counts)
+            logger.info(f"房间同步任务完成！{len(counts)}/{len(current)} 个房间查询成功，{changed} 个房间人数有变化。")
+        except Exception as e:
+            logger.error(f"发生数据库级别错误: {e}")
+            logger.error(traceback.format_exc())
+
+    async def refresh_room(self, room_id: str):
+        try:
+            current = await self._current_counts(room_id)
+            if not current:
+                return
+            counts = await self._fetch_counts([room_id])
+            await self._write_changes(current, counts)
+        except Exception as e:
+            logger.error(f"刷新房间 '{room_id}' 人数失败: {e}")
+
+    def schedule_refresh(self, room_id: str):
+        """防抖：窗口期内同一房间的多次加入只触发一次刷新"""
+        if room_id in self._pending:
+            return
+
+        async def delayed():
+            try:
+                await asyncio.sleep(self.debounce)
+                await self.refresh_room(room_id)
+            finally:
+                self._pending.pop(room_id, None)
+
+        self._pending[room_id] = asyncio.ensure_future(delayed())
+
+
+room_presence = RoomPresenceSync(SYNC_ROOMS_CONCURRENCY, SYNC_ROOM_DEBOUNCE)
 
 
 
 # 您原有的 API 端点
+# rooms_data 表结构，以及按 (room_id, time) 回放历史所依赖的联合索引
+ROOMS_DATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    room_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    time DATETIME NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rooms_data_room_time ON rooms_data (room_id, time);
+"""
+
+
+@app.on_event("startup")
+async def ensure_rooms_data_schema():
+    await room_data_db.run(lambda db: db.executescript(ROOMS_DATA_SCHEMA))
+
+
+def encode_history_cursor(row) -> str:
+    payload = json.dumps([row["time"], row["_rowid"]])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_history_cursor(cursor: str):
+    try:
+        time_value, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return time_value, int(rowid)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def fetch_room_history(room_id: str, start=None, end=None, after=None, limit: int = None):
+    """
+    按 (time, rowid) 做 keyset 分页读取房间历史，走 (room_id, time) 索引。
+    after 是上一页最后一行的 (time, rowid)。
+    """
+    sql = "SELECT rowid AS _rowid, key, prompt, time, x, y FROM rooms_data WHERE room_id = ?"
+    params = [room_id]
+    if start is not None:
+        sql += " AND time >= ?"
+        params.append(start)
+    if end is not None:
+        sql += " AND time <= ?"
+        params.append(end)
+    if after is not None:
+        sql += " AND (time, rowid) > (?, ?)"
+        params.extend(after)
+    sql += " ORDER BY time, rowid"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return await room_data_db.fetchall(sql, params)
+
+
+def strip_history_row(row):
+    return {key: value for key, value in row.items() if key != "_rowid"}
+
+
+async def stream_room_history(room_id: str, start, end, after):
+    # 逐批按 keyset 读取并立即输出，内存占用与房间历史长度无关
+    while True:
+        rows = await fetch_room_history(room_id, start, end, after, ROOM_DATA_STREAM_BATCH)
+        if not rows:
+            return
+        yield "".join(json.dumps(strip_history_row(row), ensure_ascii=False) + "\n" for row in rows)
+        if len(rows) < ROOM_DATA_STREAM_BATCH:
+            return
+        after = (rows[-1]["time"], rows[-1]["_rowid"])
+
+
 @app.get('/server/api/room_data/{room_id}')
-async def get_rooms_data(room_id: str, start: str = None, end: str = None, db: sqlite3.Connection = Depends(get_room_data_db)):
+async def get_rooms_data(room_id: str, start: str = None, end: str = None, limit: int = None,
+                         cursor: str = None, format: str = None):
+    """
+    房间历史。默认返回完整列表（兼容旧客户端）；
+    传 limit/cursor 时返回 {"items", "next_cursor"} 分页结果；format=ndjson 时以流的形式逐行输出。
+    """
     logger.info(f"Getting rooms data for room: {room_id}")
-    # ... (rest of the function logic is unchanged)
-    if start is None and end is None:
-        rooms_rows = db.execute(
-            "SELECT key, prompt, time, x, y FROM rooms_data WHERE room_id = ? ORDER BY time", (room_id,)).fetchall()
-    elif end is None:
-        rooms_rows = db.execute("SELECT key, prompt, time, x, y FROM rooms_data WHERE room_id = ? AND time >= ? ORDER BY time",
-                                (room_id, start)).fetchall()
-    elif start is None:
-        rooms_rows = db.execute("SELECT key, prompt, time, x, y FROM rooms_data WHERE room_id = ? AND time <= ? ORDER BY time",
-                                (room_id, end)).fetchall()
-    else:
-        rooms_rows = db.execute("SELECT key, prompt, time, x, y FROM rooms_data WHERE room_id = ? AND time >= ? AND time <= ? ORDER BY time",
-                                (room_id, start, end)).fetchall()
-    return rooms_rows
+    after = decode_history_cursor(cursor) if cursor else None
+
+    if format == "ndjson":
+        return StreamingResponse(
+            stream_room_history(room_id, start, end, after),
+            media_type="application/x-ndjson",
+        )
+
+    if limit is None and cursor is None:
+        rows = await fetch_room_history(room_id, start, end)
+        return [strip_history_row(row) for row in rows]
+
+    limit = min(max(limit or ROOM_DATA_PAGE_SIZE, 1), ROOM_DATA_MAX_PAGE_SIZE)
+    # 多取一行用于判断是否还有下一页
+    rows = await fetch_room_history(room_id, start, end, after, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [strip_history_row(row) for row in rows],
+        "next_cursor": encode_history_cursor(rows[-1]) if has_more else None,
+    }
 
 
 @app.get('/server/api/health')
@@ -209,10 +1866,64 @@ async def health_check():
     """简单的健康检查端点"""
     return {"status": "healthy", "service": "sd-multiplayer-backend"}
 
+# 控制器按 sd_active_jobs / sd_queue_length 做扩缩容
+metrics.register(Gauge("sd_active_jobs", "Generation jobs currently running", lambda: generation_scheduler.active))
+metrics.register(Gauge("sd_queue_length", "Generation jobs waiting in the queue", lambda: generation_scheduler.depth))
+metrics.register(Gauge("sd_outbound_in_flight", "Outbound HTTP requests in flight", lambda: http_client.in_flight))
+metrics.register(Gauge("sd_liveblocks_in_flight", "Liveblocks REST requests in flight",
+                       lambda: liveblocks_client.in_flight))
+metrics.register(Gauge("sd_stability_circuit_open", "Stability API endpoints whose circuit breaker is open",
+                       lambda: sum(endpoint.breaker.state == "open" for endpoint in stability_pool.endpoints)))
+metrics.register(Gauge("sd_stability_endpoints", "Configured Stability API keys/endpoints",
+                       lambda: len(stability_pool.endpoints)))
+metrics.register(Gauge("sd_log_records_dropped", "Log records dropped because the log queue was full",
+                       lambda: log_queue_handler.dropped))
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get('/server/api/debug/traces')
+async def get_traces(limit: int = 20, min_ms: float = 0):
+    """最近的生成链路 trace，按时间倒序；min_ms 只返回总耗时不低于该值的 trace"""
+    traces = [trace for trace in reversed(tracer.traces) if trace["duration_ms"] >= min_ms]
+    return {"sample_rate": tracer.sample_rate, "traces": traces[:max(1, min(limit, TRACE_BUFFER_SIZE))]}
+
+
+@app.get('/server/api/debug/traces/{trace_id}')
+async def get_trace(trace_id: str):
+    trace = tracer.find(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trace not found")
+    return trace
+
+
+@app.get('/server/api/generation/queue')
+async def get_generation_queue():
+    """生成队列的实时深度和每个任务的等待时间"""
+    return generation_scheduler.snapshot()
+
+@app.get('/server/api/stability/pool')
+async def get_stability_pool():
+    """Stability API key 池中每个 key 的在途请求、令牌桶等待和熔断状态（不返回 key 本身）"""
+    return {"selection": stability_pool.selection, "endpoints": stability_pool.snapshot()}
+
+@app.get('/server/api/generation/routing')
+async def get_generation_routing():
+    """各生成档位最近的延迟分位数，以及按当前排队深度预计的队尾 p95 延迟"""
+    return tier_router.snapshot()
+
+@app.get('/server/api/image/stats')
+async def get_image_stats():
+    """图片处理线程池各阶段的调用次数和耗时，以及 /storage 热点缓存的命中情况"""
+    return {**image_processor.snapshot(), "storage": storage_files.snapshot()}
+
 @app.get('/server/api/rooms')
-async def get_rooms(db: sqlite3.Connection = Depends(get_room_db)):
+async def get_rooms():
     logger.info("Getting all rooms")
-    rooms = db.execute("SELECT * FROM rooms").fetchall()
+    rooms = await room_db.fetchall("SELECT * FROM rooms")
     return rooms
 
 
@@ -226,56 +1937,734 @@ async def autorize(request: Request):
             "name": "Anon"
         }}
 
-    response = requests.post(f"https://api.liveblocks.io/v2/rooms/{room}/authorize",
-                             headers={"Authorization": f"Bearer {LIVEBLOCKS_SECRET}"}, json=payload)
+    response = await liveblocks_client.post(f"https://api.liveblocks.io/v2/rooms/{room}/authorize",
+                                      headers={"Authorization": f"Bearer {LIVEBLOCKS_SECRET}"}, json=payload)
     if response.status_code == 200:
-        sync_rooms()
+        # 配置了 webhook 时人数由 userEntered/userLeft 事件驱动，只留定时对账兜底；
+        # 否则只刷新当前房间的人数（防抖、后台执行），不阻塞加入房间的响应
+        if not LIVEBLOCKS_WEBHOOK_SECRET:
+            room_presence.schedule_refresh(room)
         return response.json()
     else:
         raise Exception(response.status_code, response.text)
 
 
+# --- Liveblocks webhook ---
+LIVEBLOCKS_PRESENCE_EVENTS = {"userEntered": 1, "userLeft": -1}
+
+
+def verify_liveblocks_webhook(body: bytes, headers, secret: str, tolerance: int = WEBHOOK_TOLERANCE) -> bool:
+    """
+    校验 Liveblocks（Svix 格式）webhook 签名：
+    对 "{webhook-id}.{webhook-timestamp}.{body}" 做 HMAC-SHA256，密钥为 whsec_ 之后的 base64 内容。
+    """
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not (webhook_id and timestamp and signatures):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+        key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    except ValueError:
+        return False
+
+    signed = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    for signature in signatures.split():
+        version, _, value = signature.partition(",")
+        if version == "v1" and hmac.compare_digest(value, expected):
+            return True
+    return False
+
+
+# webhook 可能重试投递，记住最近处理过的事件 id 以去重
+_seen_webhook_ids = OrderedDict()
+
+
+def remember_webhook_id(webhook_id: str):
+    _seen_webhook_ids[webhook_id] = True
+    if len(_seen_webhook_ids) > 10000:
+        _seen_webhook_ids.popitem(last=False)
+
+
+@app.post('/server/api/liveblocks/webhook')
+async def liveblocks_webhook(request: Request):
+    if not LIVEBLOCKS_WEBHOOK_SECRET:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Webhook not configured")
+
+    body = await request.body()
+    if not verify_liveblocks_webhook(body, request.headers, LIVEBLOCKS_WEBHOOK_SECRET):
+        logger.warning("收到签名无效的 Liveblocks webhook，已拒绝。")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid signature")
+
+    webhook_id = request.headers["webhook-id"]
+    if webhook_id in _seen_webhook_ids:
+        return {"status": "duplicate"}
+
+    try:
+        event = json.loads(body)
+    except ValueError:
+        event = None
+    if not isinstance(event, dict) or not isinstance(event.get("data", {}), dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Payload must be a JSON object")
+    delta = LIVEBLOCKS_PRESENCE_EVENTS.get(event.get("type"))
+    if delta is None:
+        remember_webhook_id(webhook_id)
+        return {"status": "ignored"}
+
+    data = event.get("data", {})
+    room_id = data.get("roomId")
+    if not room_id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing roomId")
+    users_count = await room_presence.apply_event(room_id, delta, data.get("numActiveUsers"))
+    # 写入成功后才记为已处理；失败返回 500 时 Liveblocks 的重试不能被当成重复事件丢掉
+    remember_webhook_id(webhook_id)
+    return {"status": "ok", "room_id": room_id, "users_count": users_count}
+
+
 # 保留上传社区文件的功能
 FILE_TYPES = {
     'image/png': 'png',
     'image/jpeg': 'jpg',
     'image/webp': 'webp',
 }
+UPLOAD_MAX_BYTES = int(100E+06)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
 @app.post('/server/api/uploadfile')
 async def create_upload_file(file: UploadFile):
     # --- MONITORING: Monitor file operations ---
+    # 按块流式处理：首块嗅探类型，边读边校验大小、计算哈希并写入临时文件，完成后原子重命名
     full_path = None
+    tmp_path = None
     try:
-        contents = await file.read()
-        file_size = len(contents)
-        if not 0 < file_size < 100E+06:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail='Supported file size is less than 2 MB'
-            )
-        file_type = magic.from_buffer(contents, mime=True)
-        if file_type.lower() not in FILE_TYPES:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f'Unsupported file type {file_type}. Supported types are {FILE_TYPES}'
-            )
-
-        relative_path = Path("community") / file.filename
+        filename = Path(file.filename or "").name
+        if not filename:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Missing file name')
+        relative_path = Path("community") / filename
         full_path = LOCAL_STORAGE_PATH / relative_path
         full_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(full_path, "wb") as f:
-            f.write(contents)
+        tmp_path = full_path.with_name(f".{filename}.{shortuuid.uuid()}.part")
+
+        file_size = 0
+        sha256 = hashlib.sha256()
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if file_size == 0:
+                    file_type = magic.from_buffer(chunk, mime=True)
+                    if file_type.lower() not in FILE_TYPES:
+                        raise HTTPException(
+                            status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f'Unsupported file type {file_type}. Supported types are {FILE_TYPES}'
+                        )
+                file_size += len(chunk)
+                if file_size >= UPLOAD_MAX_BYTES:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f'Supported file size is less than {UPLOAD_MAX_BYTES / 1E+06:.0f} MB'
+                    )
+                sha256.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
 
-        return {"url": f'/storage/{relative_path.as_posix()}', "filename": file.filename}
+        if file_size == 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Empty file')
+
+        os.replace(tmp_path, full_path)
+        tmp_path = None
+        UPLOAD_SIZE.observe(file_size)
+
+        return {
+            "url": f'/storage/{relative_path.as_posix()}',
+            "filename": filename,
+            "size": file_size,
+            "sha256": sha256.hexdigest(),
+        }
     except (IOError, PermissionError) as e:
         path_str = str(full_path) if full_path else "Unknown"
         logger.error(f"社区文件上传失败！检查磁盘空间或文件夹权限。路径: {path_str}. 错误: {e}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Could not save file.")
+    finally:
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
     # --- MONITORING END ---
 
     
+# 缩略图 / 多分辨率派生图
+def resolve_storage_path(path: str) -> Path:
+    """把 /storage 下的相对路径解析为本地文件，拒绝越出 LOCAL_STORAGE_PATH 的路径"""
+    root = LOCAL_STORAGE_PATH.resolve()
+    full_path = (root / path).resolve()
+    if root not in full_path.parents or not full_path.is_file():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return full_path
+
+
+# /storage 静态文件服务
+# 房间目录下生成的文件 {room_id}/{date}-{id}-{image_key}-{slug}.webp，以及 timelapse 和 blobs 下的文件写入后不再改变，
+# 这些文件返回 immutable 的长缓存头；其余文件用强 ETag 协商缓存。社区上传按客户端给的文件名原地覆盖，
+# 即使文件名碰巧符合生成文件的格式也不能当作不可变。
+# 支持单区间的 Range 请求，小文件在内存中按 LRU 缓存，city.webp 等热点文件不必每次读盘。
+IMMUTABLE_FILE_PATTERN = re.compile(r'^\d+-[A-Za-z0-9]+-.+\.webp$')
+IMMUTABLE_DIRS = ("timelapse", "blobs")
+MUTABLE_DIRS = ("community", "gallery", "tiles")
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class StorageFiles:
+    """替代 StaticFiles 的 ASGI 应用，挂载在 /storage"""
+
+    def __init__(self, directory: Path, hot_cache_max_bytes: int, hot_object_max_bytes: int):
+        self.directory = directory
+        self.hot_cache_max_bytes = hot_cache_max_bytes
+        self.hot_object_max_bytes = hot_object_max_bytes
+        self.hot_bytes = 0
+        self._hot = OrderedDict()  # (路径, ETag) -> bytes，只在事件循环中访问
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "partial": 0}
+
+    @staticmethod
+    def is_immutable(relative_path: str) -> bool:
+        parts = relative_path.split("/")
+        if parts[0] in IMMUTABLE_DIRS:
+            return True
+        return len(parts) == 2 and parts[0] not in MUTABLE_DIRS and bool(IMMUTABLE_FILE_PATTERN.match(parts[1]))
+
+    @staticmethod
+    def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+        """解析单区间 Range，返回 [start, end]；多区间或格式不对时返回 None（按完整响应处理）"""
+        match = RANGE_PATTERN.match(header.strip())
+        if not match or match.group(1) == match.group(2) == "":
+            return None
+        if match.group(1) == "":
+            return max(size - int(match.group(2)), 0), size - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+        return start, min(end, size - 1)
+
+    def _hot_get(self, key) -> Optional[bytes]:
+        data = self._hot.get(key)
+        if data is not None:
+            self._hot.move_to_end(key)
+        return data
+
+    def _hot_put(self, key, data: bytes):
+        if len(data) > self.hot_object_max_bytes or key in self._hot:
+            return
+        self._hot[key] = data
+        self.hot_bytes += len(data)
+        while self.hot_bytes > self.hot_cache_max_bytes and self._hot:
+            _, evicted = self._hot.popitem(last=False)
+            self.hot_bytes -= len(evicted)
+
+    def _read_range(self, path: Path, start: int, length: int):
+        with open(path, "rb") as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(STORAGE_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "hot_objects": len(self._hot), "hot_bytes": self.hot_bytes}
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        response = await self.get_response(request, scope["path"].lstrip("/"))
+        await response(scope, receive, send)
+
+    async def get_response(self, request: Request, relative_path: str) -> Response:
+        if request.method not in ("GET", "HEAD"):
+            return Response(status_code=status.HTTP_405_METHOD_NOT_ALLOWED, headers={"Allow": "GET, HEAD"})
+        root = self.directory.resolve()
+        full_path = (root / relative_path).resolve()
+        if root not in full_path.parents:
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        try:
+            stat = await asyncio.to_thread(full_path.stat)
+        except (FileNotFoundError, NotADirectoryError):
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+        if not full_path.is_file():
+            return Response(status_code=status.HTTP_404_NOT_FOUND)
+
+        size = stat.st_size
+        etag = f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{size:x}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "public, max-age=31536000, immutable" if self.is_immutable(relative_path)
+            else "public, no-cache",
+        }
+        media_type = mimetypes.guess_type(full_path.name)[0] or "application/octet-stream"
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            self.stats["not_modified"] += 1
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        byte_range = None
+        range_header = request.headers.get("range")
+        if range_header and request.headers.get("if-range", etag) == etag:
+            byte_range = self.parse_range(range_header, size)
+            if byte_range is not None and byte_range[0] > byte_range[1]:
+                return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                                headers={**headers, "Content-Range": f"bytes */{size}"})
+
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+        status_code = status.HTTP_200_OK
+        if byte_range is not None:
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            self.stats["partial"] += 1
+        if request.method == "HEAD":
+            return Response(status_code=status_code, media_type=media_type,
+                            headers={**headers, "Content-Length": str(length)})
+
+        hot_key = (str(full_path), etag)
+        data = self._hot_get(hot_key)
+        if data is None and size <= self.hot_object_max_bytes:
+            self.stats["misses"] += 1
+            data = await asyncio.to_thread(full_path.read_bytes)
+            self._hot_put(hot_key, data)
+        elif data is not None:
+            self.stats["hits"] += 1
+        if data is not None:
+            return Response(content=data[start:end + 1], status_code=status_code, media_type=media_type, headers=headers)
+
+        # 大文件不进内存缓存，按块流式读取
+        self.stats["misses"] += 1
+        headers["Content-Length"] = str(length)
+        return StreamingResponse(iterate_in_threadpool(self._read_range(full_path, start, length)),
+                                 status_code=status_code, media_type=media_type, headers=headers)
+
+
+storage_files = StorageFiles(LOCAL_STORAGE_PATH, STORAGE_HOT_CACHE_MAX_BYTES, STORAGE_HOT_OBJECT_MAX_BYTES)
+
+
+@app.get('/server/api/derivative/{path:path}')
+async def get_derivative(path: str, w: int = 256, q: int = 80):
+    """
+    返回 /storage/{path} 的缩小版 WebP，例如 ?w=256。
+    宽度向上取整到固定档位，按需在图片线程池中生成，并缓存在磁盘上。
+    """
+    full_path = resolve_storage_path(path)
+    width = next((candidate for candidate in DERIVATIVE_WIDTHS if candidate >= w), DERIVATIVE_WIDTHS[-1])
+    quality = min(max(q, 30), 95)
+    stat = full_path.stat()
+    cache_key = derivative_cache.make_key(path, stat.st_mtime_ns, stat.st_size, width, quality)
+
+    try:
+        data, _ = await derivative_cache.get_or_create(
+            cache_key, lambda: image_processor.derivative(full_path, width, quality)
+        )
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.error(f"生成派生图失败: {path}, 错误: {e}")
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Unsupported image")
+
+    return Response(
+        content=data,
+        media_type="image/webp",
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{cache_key}"'},
+    )
+
+
+# 房间瓦片：/server/api/tiles/{room_id} 返回 manifest，瓦片地址为 /server/api/tiles/{room_id}/{z}/{x}/{y}.webp
+ROOM_ID_PATTERN = re.compile(r'^[\w-]+$')
+
+
+STORAGE_RESERVED_DIRS = ("community", "gallery", "tiles", "timelapse", "blobs")
+
+
+def check_room_id(room_id: str):
+    if not ROOM_ID_PATTERN.match(room_id):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid room id")
+
+
+async def check_room_exists(room_id: str):
+    """会在磁盘上构建数据的接口先确认房间存在（有存储目录或在 rooms 表中），随意的房间 id 直接 404"""
+    if room_id not in STORAGE_RESERVED_DIRS:
+        if (LOCAL_STORAGE_PATH / room_id).is_dir():
+            return
+        try:
+            if await room_db.fetchall("SELECT 1 FROM rooms WHERE room_id = ?", (room_id,)):
+                return
+        except sqlite3.Error as e:
+            logger.warning(f"查询房间 '{room_id}' 是否存在失败: {e}")
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+
+
+@app.get('/server/api/tiles/{room_id}')
+async def get_room_tiles_manifest(room_id: str):
+    check_room_id(room_id)
+    await check_room_exists(room_id)
+    manifest = await tile_pyramid.ensure_built(room_id)
+    return {**manifest, "url": f"/server/api/tiles/{room_id}/{{z}}/{{x}}/{{y}}.webp"}
+
+
+@app.get('/server/api/tiles/{room_id}/{z}/{tx}/{ty}.webp')
+async def get_room_tile(room_id: str, z: int, tx: int, ty: int, request: Request):
+    check_room_id(room_id)
+    if not 0 <= z < tile_pyramid.levels:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tile not found")
+    await check_room_exists(room_id)
+    await tile_pyramid.ensure_built(room_id)
+    path = tile_pyramid.tile_path(room_id, z, tx, ty)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tile not found")
+
+    # 瓦片会随新画框更新，用 ETag 协商缓存
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=await asyncio.to_thread(path.read_bytes), media_type="image/webp", headers=headers)
+
+
+# 房间启动包：一次请求拿到画布首屏所需的全部内容
+BUNDLE_FORMAT = "sdm-bundle-v1"
+BUNDLE_CHUNK_SIZE = 256 * 1024
+
+
+async def room_snapshot_etag(room_id: str, *variant) -> str:
+    rows = await room_data_db.fetchall(
+        "SELECT COUNT(*) AS frames, MAX(rowid) AS last_rowid, MAX(time) AS last_time FROM rooms_data WHERE room_id = ?",
+        (room_id,),
+    )
+    version = DiskCache.make_key(room_id, rows[0], *variant)
+    return f'"{version[:32]}"'
+
+
+def collect_bundle_entries(room_id: str, rows):
+    """在线程中读取每个画框的文件大小，计算它在打包数据中的偏移量"""
+    entries = []
+    offset = 0
+    background_path = GALLERY_PATH / DEFAULT_BACKGROUND_IMAGE
+    if background_path.is_file():
+        length = background_path.stat().st_size
+        entries.append(("background", background_path, {"url": f"/storage/gallery/{DEFAULT_BACKGROUND_IMAGE}",
+                                                        "offset": offset, "length": length}))
+        offset += length
+    for row in rows:
+        path = LOCAL_STORAGE_PATH / room_id / str(row["key"])
+        try:
+            length = path.stat().st_size
+        except FileNotFoundError:
+            continue
+        frame = strip_history_row(row)
+        frame.update({"url": f"/storage/{room_id}/{row['key']}", "offset": offset, "length": length})
+        entries.append(("frame", path, frame))
+        offset += length
+    return entries
+
+
+async def stream_bundle(manifest_bytes: bytes, entries):
+    yield struct.pack(">I", len(manifest_bytes)) + manifest_bytes
+    for _, path, _ in entries:
+        with open(path, "rb") as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, BUNDLE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def render_room_composite(room_id: str, bounds, level: int) -> bytes:
+    """用瓦片金字塔第 level 层拼出整个房间的画布"""
+    scale = 2 ** level
+    span = tile_pyramid.tile_size * scale
+    x0, y0, x1, y1 = bounds
+    canvas = Image.new("RGBA", (max(1, -(-(x1 - x0) // scale)), max(1, -(-(y1 - y0) // scale))))
+    for ty in range(y0 // span, (y1 - 1) // span + 1):
+        for tx in range(x0 // span, (x1 - 1) // span + 1):
+            path = tile_pyramid.tile_path(room_id, level, tx, ty)
+            if path.is_file():
+                with Image.open(path) as tile:
+                    canvas.paste(tile, ((tx * span - x0) // scale, (ty * span - y0) // scale))
+    buffer = io.BytesIO()
+    canvas.save(buffer, format="WEBP", quality=85)
+    return buffer.getvalue()
+
+
+@app.get('/server/api/rooms/{room_id}/bootstrap')
+async def get_room_bootstrap(room_id: str, request: Request, mode: str = "bundle", max_size: int = 2048):
+    """
+    房间启动包，附带 ETag 供客户端判断是否需要重新下载。
+    mode=bundle：4 字节大端的 manifest 长度 + manifest JSON + 按 manifest 偏移量依次拼接的背景图和全部画框；
+    mode=composite：用瓦片金字塔合成的整张画布（WebP），最长边不超过 max_size，位置信息在响应头里。
+    """
+    check_room_id(room_id)
+    if mode not in ("bundle", "composite"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="mode must be bundle or composite")
+    max_size = min(max(max_size, 64), COMPOSITE_MAX_SIZE)
+
+    etag = await room_snapshot_etag(room_id, mode, max_size)
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if mode == "composite":
+        await check_room_exists(room_id)
+        manifest = await tile_pyramid.ensure_built(room_id)
+        bounds = manifest["bounds"]
+        if bounds is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room is empty")
+        longest = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+        level = 0
+        while level < tile_pyramid.levels - 1 and longest / 2 ** level > max_size:
+            level += 1
+        if longest / 2 ** level > COMPOSITE_MAX_SIZE:
+            # 房间大到最粗的一层也超出上限，不在服务端分配这么大的画布
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail="Room is too large for a composite; use the tiles API")
+        data = await image_processor.run("composite", render_room_composite, room_id, bounds, level)
+        headers.update({
+            "X-Room-Bounds": ",".join(str(v) for v in bounds),
+            "X-Room-Scale": str(2 ** level),
+        })
+        return Response(content=data, media_type="image/webp", headers=headers)
+
+    rows = []
+    after = None
+    while True:
+        page = await fetch_room_history(room_id, after=after, limit=ROOM_DATA_MAX_PAGE_SIZE)
+        rows.extend(page)
+        if len(page) < ROOM_DATA_MAX_PAGE_SIZE:
+            break
+        after = (page[-1]["time"], page[-1]["_rowid"])
+
+    entries = await asyncio.to_thread(collect_bundle_entries, room_id, rows)
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "room_id": room_id,
+        "background": next((meta for kind, _, meta in entries if kind == "background"), None),
+        "frames": [meta for kind, _, meta in entries if kind == "frame"],
+    }
+    manifest_bytes = json.dumps(manifest, ensure_ascii=False).encode("utf-8")
+    headers["X-Bundle-Format"] = BUNDLE_FORMAT
+    headers["Content-Length"] = str(4 + len(manifest_bytes) + sum(meta["length"] for _, _, meta in entries))
+    return StreamingResponse(stream_bundle(manifest_bytes, entries), media_type="application/octet-stream",
+                             headers=headers)
+
+
+# 房间延时动画导出
+# 按 rooms_data 的时间顺序，把房间的每个画框依次编码成动画 WebP。
+# 每 TIMELAPSE_SEGMENT_FRAMES 帧编码成一段并缓存；导出时在 RIFF 容器层面把各段的 ANMF 帧块直接拼接，
+# 房间变长后只需编码新增的帧。每段的第一帧都是完整画布，所以拼接后的动画依然正确。
+def timelapse_frame_path(room_id: str, key: str) -> Path:
+    # 文件名格式: {date}-{id}-{image_key}-{slug}.webp，timelapse 副本为 {id}.webp
+    parts = key.split("-")
+    if len(parts) > 1:
+        path = LOCAL_STORAGE_PATH / "timelapse" / room_id / f"{parts[1]}.webp"
+        if path.is_file():
+            return path
+    return LOCAL_STORAGE_PATH / room_id / key
+
+
+def encode_timelapse_segment(paths, size: int, duration: int) -> bytes:
+    """逐帧读取并缩放到 size x size（等比缩放后居中），编码成一段动画 WebP"""
+    frames = []
+    for path in paths:
+        canvas = Image.new("RGB", (size, size))
+        try:
+            with Image.open(path) as frame:
+                frame.draft("RGB", (size, size))
+                frame = frame.convert("RGB")
+                frame.thumbnail((size, size), RESAMPLING_FILTER)
+                canvas.paste(frame, ((size - frame.width) // 2, (size - frame.height) // 2))
+        except (FileNotFoundError, OSError) as e:
+            logger.warning(f"延时动画跳过无法读取的画框 {path}: {e}")
+        frames.append(canvas)
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="WEBP", save_all=True, append_images=frames[1:],
+                   duration=duration, loop=0, quality=75)
+    return buffer.getvalue()
+
+
+def iter_riff_chunks(data: bytes):
+    offset = 12
+    while offset + 8 <= len(data):
+        fourcc = data[offset:offset + 4]
+        size = struct.unpack("<I", data[offset + 4:offset + 8])[0]
+        end = offset + 8 + size + (size & 1)
+        yield fourcc, data[offset:end]
+        offset = end
+
+
+def riff_chunk(fourcc: bytes, payload: bytes) -> bytes:
+    return fourcc + struct.pack("<I", len(payload)) + payload + b"\0" * (len(payload) & 1)
+
+
+def split_animated_webp(data: bytes, size: int, duration: int):
+    """
+    返回 (VP8X 与 ANIM 头部块, 所有 ANMF 帧块)。
+    只有一帧或各帧完全相同时 libwebp 会输出静态 WebP（只有 VP8/VP8L 和可选的 ALPH 块），
+    这时把它包成一个持续 duration 毫秒、铺满 size x size 画布的 ANMF 帧，并补上动画头部。
+    """
+    header, frames, still = b"", [], b""
+    for fourcc, chunk in iter_riff_chunks(data):
+        if fourcc in (b"VP8X", b"ANIM"):
+            header += chunk
+        elif fourcc == b"ANMF":
+            frames.append(chunk)
+        elif fourcc in (b"ALPH", b"VP8 ", b"VP8L"):
+            still += chunk
+    if not frames and still:
+        dimensions = (size - 1).to_bytes(3, "little") * 2
+        # 偏移 (0, 0)、帧尺寸、时长，标志位 0x02 表示不与上一帧混合
+        frames.append(riff_chunk(b"ANMF", b"\0" * 6 + dimensions + min(duration, 0xFFFFFF).to_bytes(3, "little")
+                                 + b"\x02" + still))
+        flags = 0x02 | (0x10 if still.startswith(b"ALPH") else 0)  # 动画，有 ALPH 时再加上 alpha 标志
+        header = riff_chunk(b"VP8X", bytes([flags, 0, 0, 0]) + dimensions) + riff_chunk(b"ANIM", b"\0" * 6)
+    return header, b"".join(frames)
+
+
+@app.get('/server/api/rooms/{room_id}/timelapse.webp')
+async def get_room_timelapse(room_id: str, request: Request, size: int = 256, fps: int = 4):
+    check_room_id(room_id)
+    size = next((candidate for candidate in DERIVATIVE_WIDTHS if candidate >= size), DERIVATIVE_WIDTHS[-1])
+    duration = int(1000 / min(max(fps, 1), 30))
+
+    etag = await room_snapshot_etag(room_id, "timelapse", size, duration)
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    keys = []
+    after = None
+    while True:
+        page = await fetch_room_history(room_id, after=after, limit=ROOM_DATA_MAX_PAGE_SIZE)
+        keys.extend(str(row["key"]) for row in page)
+        if len(page) < ROOM_DATA_MAX_PAGE_SIZE:
+            break
+        after = (page[-1]["time"], page[-1]["_rowid"])
+    if not keys:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room has no frames")
+
+    segments = [keys[i:i + TIMELAPSE_SEGMENT_FRAMES] for i in range(0, len(keys), TIMELAPSE_SEGMENT_FRAMES)]
+
+    async def load_segment(segment):
+        cache_key = timelapse_cache.make_key(room_id, size, duration, segment)
+        paths = [timelapse_frame_path(room_id, key) for key in segment]
+        data, _ = await timelapse_cache.get_or_create(
+            cache_key, lambda: image_processor.run("timelapse", encode_timelapse_segment, paths, size, duration)
+        )
+        return split_animated_webp(data, size, duration * len(segment))
+
+    # 第一遍：确保每一段都已编码（命中缓存的段直接跳过），并计算 RIFF 总长度
+    header, total = b"", 0
+    for segment in segments:
+        segment_header, frames = await load_segment(segment)
+        header = header or segment_header
+        total += len(frames)
+
+    async def stream():
+        yield b"RIFF" + struct.pack("<I", 4 + len(header) + total) + b"WEBP" + header
+        # 第二遍：逐段从缓存读取并输出，任何时候内存里只有一段
+        for segment in segments:
+            _, frames = await load_segment(segment)
+            yield frames
+
+    headers["Content-Length"] = str(12 + len(header) + total)
+    return StreamingResponse(stream(), media_type="image/webp", headers=headers)
+
+
+# 生成任务 API：提交后立即返回 job_id，进度通过房间的 SSE 事件流推送
+def decode_canvas(data_url: str) -> Image.Image:
+    """前端画布的 data URL（data:image/webp;base64,...）解码为 RGBA 图片"""
+    encoded = data_url.split(",", 1)[1] if data_url.startswith("data:") else data_url
+    return decode_image(base64.b64decode(encoded)).convert("RGBA")
+
+
+async def run_generation_job(job_id, input_image, prompt_text, strength, room_id, image_key):
+    try:
+        result = await enqueue_outpaint(job_id, input_image, prompt_text, strength, 7.5, 25, "patchmatch",
+                                        room_id, image_key)
+    except Exception as e:
+        logger.error(f"[Request ID: {job_id}] 生成任务失败: {e}")
+        job_events.update(job_id, "error", error="internal_error", message=str(e))
+        return
+    if result.get("error") or result.get("is_nsfw") or not result.get("image"):
+        job_events.update(job_id, "error", error=result.get("error", "generation_failed"),
+                          message=result.get("message"), retry_after=result.get("retry_after"),
+                          tier=result.get("tier"))
+    else:
+        job_events.update(job_id, "done", url=result["image"]["url"], filename=result["image"]["filename"],
+                          tier=result.get("tier"))
+
+
+class GenerationJobRequest(BaseModel):
+    image: str  # 画布的 data URL
+    prompt: str = ""
+    strength: float = Field(0.75, ge=0, le=1)
+    room_id: Optional[str] = None
+    image_key: str = "0_0"
+
+
+@app.post('/server/api/generation/jobs', status_code=status.HTTP_202_ACCEPTED)
+async def create_generation_job(request: Request):
+    """
+    提交生成任务，body: {"image": data URL, "prompt", "strength", "room_id", "image_key"}。
+    立即返回 job_id；状态在 /server/api/rooms/{room_id}/jobs/events 上推送，也可以查询 /server/api/generation/jobs/{job_id}。
+    """
+    try:
+        body = GenerationJobRequest.parse_obj(await request.json())
+    except (ValueError, ValidationError) as e:
+        # 非 JSON、非对象或字段类型不对都是客户端错误
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid request body: {e}")
+    room_id = body.room_id or "default"
+    check_room_id(room_id)
+    if generation_scheduler.depth >= generation_scheduler.max_queue:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            content={"error": "queue_full", "message": "Queue full"})
+    try:
+        input_image = await image_processor.run("decode", decode_canvas, body.image)
+    except (ValueError, OSError, Image.DecompressionBombError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image")
+
+    job_id = shortuuid.uuid()[:8]
+    logger.info(f"[Request ID: {job_id}] 收到生成任务。房间: {room_id}，目标尺寸: {input_image.size}")
+    job = job_events.create(job_id, room_id, body.image_key)
+    job_events.start(job_id, run_generation_job(job_id, input_image, body.prompt, body.strength, room_id,
+                                                body.image_key))
+    return {**job, "events_url": f"/server/api/rooms/{room_id}/jobs/events"}
+
+
+@app.get('/server/api/generation/jobs/{job_id}')
+async def get_generation_job(job_id: str):
+    job = job_events.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
+
+@app.get('/server/api/rooms/{room_id}/jobs/events')
+async def stream_room_job_events(room_id: str):
+    """房间内所有生成任务的 SSE 事件流，一个连接即可跟踪多个任务"""
+    check_room_id(room_id)
+
+    async def stream():
+        yield "retry: 3000\n\n"
+        async for event in job_events.subscribe(room_id):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {event['state']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 # 保留获取默认背景图的API
 @app.get("/server/api/default_background")
 async def get_default_background():
@@ -304,13 +2693,166 @@ async def get_default_background():
         return JSONResponse(status_code=500, content={"error": "无法检索默认背景图。"})
 
 
+# --- 生成档位路由 ---
+class GenerationTier:
+    def __init__(self, name: str, endpoint: str, model: str):
+        self.name = name
+        self.endpoint = endpoint
+        self.model = model
+        # 画布尺寸分桶 -> 最近的 (时间, 服务耗时)
+        self.samples = {bucket: deque(maxlen=ROUTING_WINDOW) for bucket in TierRouter.SIZE_BUCKETS}
+        # 样本不足（或已过期）时正在执行的探测任务，同一时间最多一个
+        self.probing = False
+
+
+class TierRouter:
+    """
+    按排队深度、各档位最近的服务耗时分位数和画布尺寸，为每个任务选择生成档位。
+    档位按生成缓存键固定：同一输入的请求在结果生成、写入缓存前后都使用（并报告）第一次选中的档位，
+    不会因为排队深度的变化被分到两个档位、各付一次费用。
+    """
+
+    SIZE_BUCKETS = ("small", "medium", "large")
+
+    def __init__(self, tiers, scheduler: GenerationScheduler, slo_seconds: float, fast_queue_depth: int):
+        self.tiers = tiers
+        self.scheduler = scheduler
+        self.slo_seconds = slo_seconds
+        self.fast_queue_depth = fast_queue_depth
+        # 缓存键 -> [档位, 在途请求数, 是否是探测任务]，按 LRU 保留最近 ROUTING_PINNED_KEYS 个已完成的键
+        self._pinned = OrderedDict()
+
+    @classmethod
+    def from_env(cls, scheduler: GenerationScheduler) -> "TierRouter":
+        tiers = []
+        for entry in GENERATION_TIERS.split(","):
+            name, _, target = entry.strip().partition("=")
+            if name and target:
+                endpoint, _, model = target.partition(":")
+                tiers.append(GenerationTier(name, endpoint, model))
+        if not tiers:
+            tiers = [GenerationTier("default", "sd3", "")]
+        return cls(tiers, scheduler, GENERATION_SLO_SECONDS, GENERATION_FAST_QUEUE_DEPTH)
+
+    @staticmethod
+    def size_bucket(size: Tuple[int, int]) -> str:
+        pixels = size[0] * size[1]
+        if pixels <= 768 * 768:
+            return "small"
+        if pixels <= 1280 * 1280:
+            return "medium"
+        return "large"
+
+    def percentiles(self, tier: GenerationTier, bucket: str, quantiles=(0.5, 0.95)):
+        """最近样本的分位数；该尺寸分桶样本不足时用整个档位的样本，仍不足时返回 None"""
+        cutoff = time.time() - ROUTING_MAX_AGE
+        values = [seconds for at, seconds in tier.samples[bucket] if at >= cutoff]
+        if len(values) < ROUTING_MIN_SAMPLES:
+            values = [seconds for samples in tier.samples.values() for at, seconds in samples if at >= cutoff]
+        if len(values) < ROUTING_MIN_SAMPLES:
+            return None
+        values.sort()
+        return [values[min(len(values) - 1, int(len(values) * q))] for q in quantiles]
+
+    def projected_latency(self, tier: GenerationTier, bucket: str, depth: int) -> Optional[float]:
+        """假设排队中的任务都用这个档位，队尾任务从现在起的预计 p95 延迟；没有足够样本时返回 None"""
+        stats = self.percentiles(tier, bucket)
+        if stats is None:
+            return None
+        p50, p95 = stats
+        waves = -(-depth // max(self.scheduler.max_concurrency, 1))
+        return waves * p50 + p95
+
+    def choose(self, size: Tuple[int, int], waited: float = 0.0) -> GenerationTier:
+        """waited 是当前任务已经排队的秒数：它自己的 p95 要落在剩余预算内，身后的队尾也不能超出 SLO"""
+        depth = self.scheduler.depth
+        if self.fast_queue_depth and depth >= self.fast_queue_depth:
+            return self.tiers[-1]
+        bucket = self.size_bucket(size)
+        for tier in self.tiers:
+            stats = self.percentiles(tier, bucket)
+            if stats is None:
+                # 没有样本（或样本已过期）的档位先放行一个探测任务，其余任务按下一个档位评估，
+                # 避免高峰期间一批任务同时落到还不知道有多慢的档位上
+                if tier.probing:
+                    continue
+                return tier
+            if waited + stats[1] <= self.slo_seconds and \
+                    self.projected_latency(tier, bucket, depth) <= self.slo_seconds:
+                return tier
+        return self.tiers[-1]
+
+    def acquire(self, key: str, size: Tuple[int, int], waited: float = 0.0) -> GenerationTier:
+        """为缓存键选择档位；键已固定时直接复用，需要与 release 成对调用"""
+        entry = self._pinned.get(key)
+        if entry is not None:
+            self._pinned.move_to_end(key)
+            entry[1] += 1
+            return entry[0]
+        tier = self.choose(size, waited)
+        probe = self.percentiles(tier, self.size_bucket(size)) is None
+        if probe:
+            tier.probing = True
+        self._pinned[key] = [tier, 1, probe]
+        return tier
+
+    def release(self, key: str, succeeded: bool):
+        entry = self._pinned.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        if entry[2]:
+            entry[0].probing = False
+            entry[2] = False
+        if not succeeded:
+            # 失败的键不固定档位，重试时按当时的负载重新选择
+            del self._pinned[key]
+        while len(self._pinned) > ROUTING_PINNED_KEYS:
+            oldest = next(iter(self._pinned))
+            if self._pinned[oldest][1] > 0:
+                break
+            del self._pinned[oldest]
+
+    def observe(self, tier: GenerationTier, size: Tuple[int, int], seconds: float):
+        tier.samples[self.size_bucket(size)].append((time.time(), seconds))
+        GENERATION_TIER_LATENCY.observe(seconds, tier.name)
+
+    def snapshot(self) -> dict:
+        depth = self.scheduler.depth
+        tiers = []
+        for tier in self.tiers:
+            buckets = {}
+            for bucket in self.SIZE_BUCKETS:
+                stats = self.percentiles(tier, bucket)
+                projected = self.projected_latency(tier, bucket, depth)
+                buckets[bucket] = {
+                    "p50": round(stats[0], 3) if stats else None,
+                    "p95": round(stats[1], 3) if stats else None,
+                    "projected": round(projected, 3) if projected is not None else None,
+                }
+            tiers.append({"name": tier.name, "endpoint": tier.endpoint, "model": tier.model, "probing": tier.probing,
+                          "buckets": buckets})
+        return {"slo_seconds": self.slo_seconds, "fast_queue_depth": self.fast_queue_depth,
+                "queue_depth": depth, "tiers": tiers}
+
+
+tier_router = TierRouter.from_env(generation_scheduler)
+
+
 # --- 核心改动：用 API 版本替换本地模型 ---
 
 # 本地模型加载函数 get_model() 已被完全删除
 
-# 上传/保存文件的辅助函数 (保持不变)
+# 上传/保存文件的辅助函数
 async def upload_file(image: Image.Image, prompt: str, room_id: str, image_key: str):
-    image_to_save = image.convert('RGB')
+    with tracer.span("upload_file", room_id=room_id, image_key=image_key):
+        webp_bytes = await image_processor.encode_webp(image)
+        return await save_webp_file(webp_bytes, prompt, room_id, image_key)
+
+
+async def save_webp_file(webp_bytes: bytes, prompt: str, room_id: str, image_key: str):
     id = shortuuid.uuid()
     date = int(time.time())
     prompt_slug = slugify(prompt)
@@ -322,21 +2864,32 @@ async def upload_file(image: Image.Image, prompt: str, room_id: str, image_key:
     timelapse_dir = LOCAL_STORAGE_PATH / "timelapse" / room_id
     timelapse_path = timelapse_dir / timelapse_name
     
-    full_path.parent.mkdir(parents=True, exist_ok=True)
-    timelapse_dir.mkdir(parents=True, exist_ok=True)
-    
     try:
-        image_to_save.save(full_path, format="WEBP")
-        shutil.copy(full_path, timelapse_path)
+        # 内容只写一次，房间路径和 timelapse 路径都是硬链接
+        with tracer.span("storage.write_webp", bytes=len(webp_bytes)):
+            await asyncio.to_thread(blob_store.store, webp_bytes, full_path, timelapse_path)
     except (IOError, PermissionError) as e:
         logger.error(f"文件写入失败！路径: {full_path}. 错误: {e}")
         logger.error(traceback.format_exc())
         raise
 
+    x, y = parse_image_key(image_key)
+    frame_recorder.record(room_id, filename, prompt, date, x, y)
+    tile_pyramid.schedule_frame(room_id, full_path, x, y)
+
     out = {"url": f'/storage/{key_name}', "filename": filename}
     return out
 
-# 全新重写的 run_outpaint 函数，用于调用外部 API
+
+def parse_image_key(image_key: str):
+    """前端的 image_key 形如 "{x}_{y}"，解析失败时返回 (0, 0)"""
+    try:
+        x, y = image_key.split("_", 1)
+        return int(float(x)), int(float(y))
+    except (AttributeError, ValueError):
+        return 0, 0
+
+# Gradio 入口：把生成任务交给调度器排队执行
 async def run_outpaint(
     input_image,
     prompt_text,
@@ -349,10 +2902,68 @@ async def run_outpaint(
 ):
     request_id = shortuuid.uuid()[:8]
     logger.info(f"[Request ID: {request_id}] 收到 API 请求。目标尺寸: {input_image.size}")
+    return await enqueue_outpaint(
+        request_id, input_image, prompt_text, strength, guidance, step, fill_mode, room_id, image_key
+    )
+
+
+async def enqueue_outpaint(
+    request_id,
+    input_image,
+    prompt_text,
+    strength,
+    guidance,
+    step,
+    fill_mode,
+    room_id,
+    image_key
+):
+    """Gradio 入口和任务 API 共用：排队执行生成并返回结果"""
+    enqueued_at = time.time()
+
+    with tracer.trace(request_id, "run_outpaint", room_id=room_id, image_key=image_key,
+                      size=list(input_image.size)) as root:
+        async def job():
+            # 调度器在自己的任务里执行 job，这个任务可能是在别的任务结束时派发的，继承的是那个任务的上下文；
+            # 先把当前 span 换成本请求的根 span（未采样时为 None），避免挂到无关的 trace 下
+            _current_span.set(root)
+            started_at = time.time()
+            logger.info(f"[Request ID: {request_id}] 出队开始处理，排队等待: {started_at - enqueued_at:.2f} 秒。")
+            tracer.record("queue.wait", enqueued_at, started_at, parent=root)
+            job_events.update(request_id, "started", position=None)
+            with tracer.span("generate_outpaint", parent=root):
+                # 出队时按当前负载和已排队时间选择档位
+                return await generate_outpaint(
+                    request_id, input_image, prompt_text, strength, guidance, step, fill_mode, room_id, image_key,
+                    started_at - enqueued_at
+                )
+
+        try:
+            return await generation_scheduler.submit(request_id, room_id or "default", job)
+        except QueueFullError as e:
+            logger.warning(f"[Request ID: {request_id}] {e}，拒绝请求。")
+            if root is not None:
+                root.set(error="queue_full")
+            return {"is_nsfw": False, "image": {}, "error": "queue_full", "message": "Queue full"}
+
+
+# 全新重写的生成函数，用于调用外部 API
+async def generate_outpaint(
+    request_id,
+    input_image,
+    prompt_text,
+    strength,
+    guidance,
+    step,
+    fill_mode,
+    room_id,
+    image_key,
+    queued_seconds: float = 0.0
+):
     start_time = time.time()
 
-    if not STABILITY_API_KEY:
-        error_msg = "错误：服务器未配置 STABILITY_API_KEY。"
+    if not stability_pool.endpoints:
+        error_msg = "错误：服务器未配置 STABILITY_API_KEY 或 STABILITY_API_KEYS。"
         logger.error(f"[Request ID: {request_id}] {error_msg}")
         raise Exception(error_msg)
 
@@ -361,69 +2972,435 @@ async def run_outpaint(
     target_size = input_image.size  # 例如 (1920, 1080)
     # --- END OF MODIFICATION ---
 
-    api_url = "https://api.stability.ai/v2beta/stable-image/generate/sd3"
-    headers = { "authorization": f"Bearer {STABILITY_API_KEY}", "accept": "image/*" }
-    data = { "prompt": prompt_text, "output_format": "png" }
-    files = {"none": ''}
-    img_np = np.array(input_image.convert("RGB"))
+    timings = {}
 
-    if np.std(img_np) < 10:
+    if await image_processor.is_blank(input_image, timings):
         logger.info(f"[Request ID: {request_id}] 空白画布，使用 'text-to-image' 模式。")
-        # 对于 text-to-image，保持默认的 files={"none": ''}
-
+        mode = "text-to-image"
+        # 空白画布上再次生成同一个位置就是想换一张图，不走生成缓存；
+        # 键里带上请求 ID 只是为了让档位路由按请求区分
+        digest = request_id
     else:
         logger.info(f"[Request ID: {request_id}] 有内容画布，使用 'image-to-image' 模式。")
-        data['strength'] = strength
-        image_bytes = io.BytesIO()
-        input_image.save(image_bytes, format='PNG')
-        image_bytes.seek(0)
-        files = {'image': ('init_image.png', image_bytes, 'image/png')}
+        mode = "image-to-image"
+        digest = await image_processor.digest(input_image, timings)
+
+    # 图生图的缓存键只由请求输入决定；档位按键固定，相同输入的并发请求只会调用一次上游
+    cache_key = generation_cache.make_key(prompt_text, strength, mode, digest, target_size)
+    tier = tier_router.acquire(cache_key, target_size, queued_seconds)
+    succeeded = False
 
-    logger.info(f"[Request ID: {request_id}] 正在调用 Stability API...")
+    span = _current_span.get()
+    if span is not None:
+        span.set(mode=mode, tier=tier.name)
 
     try:
-        response = requests.post(api_url, headers=headers, data=data, files=files)
-        
-        if response.status_code != 200:
-            logger.error(f"[Request ID: {request_id}] API 错误响应: {response.text}")
-            response.raise_for_status()
-        
-        # 直接从响应内容获取图片字节
-        image_bytes = response.content
-        generated_image = Image.open(io.BytesIO(image_bytes))
-        logger.info(f"[Request ID: {request_id}] 从API接收到图片，原始尺寸: {generated_image.size}")
-
-        # --- START OF MODIFICATION ---
-        # 2. 将API返回的图片缩放到目标尺寸
-        #    Image.Resampling.LANCZOS 是高质量的缩放算法
-        try:
-            resampling_filter = Image.Resampling.LANCZOS
-        except AttributeError: # 兼容旧版 Pillow
-            resampling_filter = Image.LANCZOS
-            
-        resized_image = generated_image.resize(target_size, resampling_filter)
-        logger.info(f"[Request ID: {request_id}] 图片已缩放至目标尺寸: {resized_image.size}")
-        # --- END OF MODIFICATION ---
+        async def produce():
+            return await request_generation(request_id, input_image, prompt_text, strength, mode, target_size,
+                                            timings, tier)
 
-        # 3. 将缩放后的图片传递给保存函数
-        image_url_data = await upload_file(resized_image, prompt_text, room_id, image_key)
+        if mode == "text-to-image":
+            webp_bytes, reused = await produce(), False
+        else:
+            webp_bytes, reused = await generation_cache.get_or_create(cache_key, produce, meta={"tier": tier.name})
+        # 报告实际产出结果的档位：命中磁盘缓存时键可能早已不再固定，acquire 返回的只是按当前负载选的档位
+        served_tier = tier.name
+        if reused:
+            served_tier = (await asyncio.to_thread(generation_cache.meta, cache_key)).get("tier", tier.name)
+            logger.info(f"[Request ID: {request_id}] 复用已有的生成结果 (cache key: {cache_key[:12]}，档位: {served_tier})。")
+            if span is not None:
+                span.set(cache="hit", tier=served_tier)
+
+        # 3. 将最终的 WebP 写入存储
+        with tracer.span("save_webp_file"):
+            image_url_data = await save_webp_file(webp_bytes, prompt_text, room_id, image_key)
 
         params = {
             "is_nsfw": False,  # 简化处理，新API在返回前已过滤
-            "image": image_url_data
+            "image": image_url_data,
+            "tier": served_tier,
         }
         
         duration = time.time() - start_time
-        logger.info(f"[Request ID: {request_id}] API 调用成功并处理完毕。耗时: {duration:.2f} 秒。")
+        if not reused:
+            # 记录整段服务时间（上游调用、重试、图片处理和落盘），用于预计后续任务的延迟
+            tier_router.observe(tier, target_size, duration)
+        succeeded = True
+        stages = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items())
+        logger.info(f"[Request ID: {request_id}] API 调用成功并处理完毕（档位: {served_tier}）。耗时: {duration:.2f} 秒。图片处理阶段: {stages or '无'}")
         return params
 
+    except UpstreamError as e:
+        duration = time.time() - start_time
+        logger.error(f"[Request ID: {request_id}] 调用API失败 ({e.code})：{e.message}。耗时: {duration:.2f} 秒。")
+        if span is not None:
+            span.set(error=e.code)
+        result = {"is_nsfw": e.code == "content_filtered", "image": {}, "error": e.code, "message": e.message,
+                  "tier": tier.name}
+        if e.retry_after is not None:
+            result["retry_after"] = round(e.retry_after, 1)
+        return result
+
     except Exception as e:
         duration = time.time() - start_time
         logger.error(f"[Request ID: {request_id}] 调用API时发生错误。耗时: {duration:.2f} 秒。")
-        if 'response' in locals() and response:
-            logger.error(f"API 响应内容: {response.text}")
         logger.error(traceback.format_exc())
-        return {"is_nsfw": True, "image": {}}
+        return {"is_nsfw": False, "image": {}, "error": "internal_error", "message": "Generation failed",
+                "tier": tier.name}
+
+    finally:
+        # 文生图的键每次都不同，结束后不必占用固定档位的名额
+        tier_router.release(cache_key, succeeded and mode == "image-to-image")
+
+
+# --- Stability API 容错：重试、熔断和明确的错误类型 ---
+class UpstreamError(Exception):
+    """
+    上游调用失败，code 会原样返回给前端：
+    rate_limited / upstream_unavailable / upstream_timeout / circuit_open / content_filtered / bad_request / upstream_error
+    """
+
+    def __init__(self, code: str, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# 请求还没有发到上游的传输错误，重试不会重复生成
+UNSENT_REQUEST_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitBreaker:
+    """
+    连续失败达到阈值后熔断，reset_timeout 秒内直接失败；之后放行一个探测请求（half-open），
+    探测成功则恢复，失败则重新计时。只有 5xx 和网络错误计入失败，429 只是限流，不熔断。
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allows_call(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._probing)
+
+    def before_call(self) -> bool:
+        """熔断时抛出 circuit_open；返回这次调用是否占用了 half-open 的探测名额"""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            raise UpstreamError("circuit_open", "Upstream temporarily unavailable",
+                                retry_after=round(max(remaining, 1), 1))
+        if state == "half_open":
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._probing:
+                logger.warning(f"Stability API 连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒")
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def end_probe(self):
+        """探测请求结束但没有给出成败（被限流、被取消）时归还探测名额，下一次调用重新探测"""
+        self._probing = False
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After 可以是秒数或 HTTP 日期"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter：在 [0, min(上限, base * 2^attempt)] 内均匀取值
+    return random.uniform(0, min(STABILITY_BACKOFF_MAX, STABILITY_BACKOFF_BASE * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    按预约方式工作的令牌桶：acquire() 立即扣掉一个令牌（可以扣成负数），再睡到令牌补足为止，
+    所以并发的等待者按到达顺序排队，且只在事件循环里访问，不需要锁。
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """现在申请一个令牌需要等待的秒数（不扣令牌）"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        delay = self.wait_time()
+        self.tokens -= 1
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float):
+        """上游返回 429 时，让这个 key 在 seconds 秒内没有可用令牌"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class StabilityEndpoint:
+    def __init__(self, name: str, key: str, url: str, weight: float, rate: float, burst: float):
+        self.name = name
+        self.key = key
+        self.url = url
+        self.weight = weight
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.in_flight = 0
+        self.current_weight = 0.0  # 平滑加权轮询用
+
+    def url_for(self, tier_endpoint: str) -> str:
+        """把配置的 URL 最后一段（例如 sd3）换成档位对应的 endpoint"""
+        return f"{self.url.rsplit('/', 1)[0]}/{tier_endpoint}"
+
+    def snapshot(self) -> dict:
+        return {"name": self.name, "url": self.url, "weight": self.weight, "in_flight": self.in_flight,
+                "wait_seconds": round(self.bucket.wait_time(), 3), "circuit": self.breaker.state}
+
+
+class StabilityKeyPool:
+    def __init__(self, endpoints, selection: str):
+        self.endpoints = endpoints
+        self.selection = selection
+
+    @classmethod
+    def from_env(cls) -> "StabilityKeyPool":
+        entries = [entry.strip() for entry in STABILITY_API_KEYS.split(",") if entry.strip()]
+        if not entries and STABILITY_API_KEY:
+            entries = [STABILITY_API_KEY]
+        endpoints = []
+        for index, entry in enumerate(entries):
+            key, *options = entry.split(";")
+            options = dict(option.split("=", 1) for option in options if "=" in option)
+            name = f"key{index}-{key.strip()[-4:]}"
+            numbers = {
+                "weight": float(options.get("weight", 1)),
+                "rate": float(options.get("rate", STABILITY_KEY_RATE)),
+                "burst": float(options.get("burst", STABILITY_KEY_BURST)),
+            }
+            for option, value in numbers.items():
+                # weight 为 0 会让 least_loaded 选择时除以零；rate/burst 不为正时令牌桶永远拿不到令牌
+                if not value > 0:
+                    raise ValueError(f"STABILITY_API_KEYS 第 {index + 1} 项 ({name}) 的 {option} 必须大于 0，当前为 {value}")
+            endpoints.append(StabilityEndpoint(
+                name=name,
+                key=key.strip(),
+                url=options.get("url", STABILITY_API_URL),
+                **numbers,
+            ))
+        return cls(endpoints, STABILITY_KEY_SELECTION)
+
+    def select(self) -> StabilityEndpoint:
+        """选一个未熔断的 endpoint；全部熔断时抛出 circuit_open"""
+        available = [endpoint for endpoint in self.endpoints if endpoint.breaker.allows_call()]
+        if not available:
+            retry_after = min(endpoint.breaker.reset_timeout - (time.monotonic() - endpoint.breaker.opened_at)
+                              for endpoint in self.endpoints)
+            raise UpstreamError("circuit_open", "Upstream temporarily unavailable",
+                                retry_after=round(max(retry_after, 1), 1))
+        if self.selection == "weighted":
+            # 平滑加权轮询（与 nginx 相同）
+            total = sum(endpoint.weight for endpoint in available)
+            for endpoint in available:
+                endpoint.current_weight += endpoint.weight
+            chosen = max(available, key=lambda endpoint: endpoint.current_weight)
+            chosen.current_weight -= total
+            return chosen
+        return min(available, key=lambda endpoint: (endpoint.bucket.wait_time(),
+                                                    endpoint.in_flight / endpoint.weight))
+
+    def snapshot(self):
+        return [endpoint.snapshot() for endpoint in self.endpoints]
+
+
+stability_pool = StabilityKeyPool.from_env()
+
+
+async def attempt_stability(request_id: str, endpoint: StabilityEndpoint, attempt: int, data: dict, files: dict,
+                            tier_endpoint: str):
+    """
+    对选中的 endpoint 发一次请求，返回 (响应, 错误, 退避秒数)：成功时错误为 None，可重试的失败时响应为 None；
+    不可重试的失败直接抛出 UpstreamError。
+    """
+    headers = {"authorization": f"Bearer {endpoint.key}", "accept": "image/*"}
+    delay = 0.0
+    start = time.perf_counter()
+    endpoint.in_flight += 1
+    try:
+        with tracer.span("stability.attempt", attempt=attempt, endpoint=endpoint.name):
+            response = await http_client.post(
+                endpoint.url_for(tier_endpoint), headers=headers, data=data, files=files,
+                read_timeout=STABILITY_READ_TIMEOUT
+            )
+    except httpx.TransportError as e:
+        STABILITY_LATENCY.observe(time.perf_counter() - start, type(e).__name__)
+        endpoint.breaker.record_failure()
+        error = UpstreamError("upstream_timeout" if isinstance(e, httpx.TimeoutException) else "upstream_unavailable",
+                              f"{type(e).__name__}: {e}")
+        if not isinstance(e, UNSENT_REQUEST_ERRORS):
+            # 请求已经发出（读超时、读到一半断开）时上游可能已经在生成并计费，
+            # 重发会重复扣费，用户也要再等一整个读取超时，直接失败
+            raise error
+        delay = backoff_delay(attempt)
+    else:
+        STABILITY_LATENCY.observe(time.perf_counter() - start, response.status_code)
+        if response.status_code == 200:
+            endpoint.breaker.record_success()
+            return response, None, 0.0
+
+        logger.error(f"[Request ID: {request_id}] API 错误响应 ({response.status_code}, {endpoint.name}): "
+                     f"{response.text[:500]}")
+        if response.status_code not in RETRYABLE_STATUS:
+            # 4xx 说明请求本身有问题，上游是健康的
+            endpoint.breaker.record_success()
+            if response.status_code == 403:
+                raise UpstreamError("content_filtered", "Prompt or image was flagged by content moderation", 403)
+            raise UpstreamError("bad_request", f"Upstream rejected the request ({response.status_code})",
+                                response.status_code)
+
+        if response.status_code == 429:
+            # 只让这个 key 冷却；下一次尝试由令牌桶决定等多久，或者换到别的 key
+            retry_after = parse_retry_after(response.headers.get("retry-after"))
+            error = UpstreamError("rate_limited", "Upstream rate limit reached", 429, retry_after=retry_after)
+            endpoint.bucket.penalize((retry_after if retry_after is not None else backoff_delay(attempt)) +
+                                     random.uniform(0, STABILITY_BACKOFF_BASE))
+        else:
+            endpoint.breaker.record_failure()
+            error = UpstreamError("upstream_unavailable", f"Upstream error ({response.status_code})",
+                                  response.status_code)
+            delay = backoff_delay(attempt)
+    finally:
+        endpoint.in_flight -= 1
+    return None, error, delay
+
+
+async def post_stability(request_id: str, data: dict, files: dict, tier_endpoint: str = "sd3") -> httpx.Response:
+    """
+    带限流、重试和熔断的 Stability API 调用，成功时返回 200 响应，否则抛出 UpstreamError。
+    每次尝试都重新从 key 池里选择，某个 key 被 429 限流后后续尝试会优先落到其他 key 上。
+    """
+    if not stability_pool.endpoints:
+        raise UpstreamError("bad_request", "No Stability API key configured")
+
+    for attempt in range(STABILITY_MAX_RETRIES + 1):
+        endpoint = stability_pool.select()
+        wait = endpoint.bucket.wait_time()
+        if wait > STABILITY_RETRY_AFTER_MAX:
+            raise UpstreamError("rate_limited", "Upstream rate limit reached", 429, retry_after=wait)
+        probing = endpoint.breaker.before_call()
+        try:
+            with tracer.span("stability.rate_limit_wait", endpoint=endpoint.name, expected=round(wait, 3)):
+                await endpoint.bucket.acquire()
+            response, error, delay = await attempt_stability(request_id, endpoint, attempt, data, files, tier_endpoint)
+        except UpstreamError:
+            raise
+        except Exception:
+            # 响应体异常、代码错误等意外情况也算上游失败，否则 half-open 的探测名额永远不会归还
+            endpoint.breaker.record_failure()
+            raise
+        finally:
+            # 429 和任务取消不计成败，但要归还探测名额，下一次调用会重新探测
+            if probing:
+                endpoint.breaker.end_probe()
+        if response is not None:
+            return response
+
+        if attempt == STABILITY_MAX_RETRIES:
+            raise error
+        logger.warning(f"[Request ID: {request_id}] {error.message}，{delay:.2f} 秒后第 {attempt + 1} 次重试。")
+        job_events.update(request_id, "retrying", attempt=attempt + 1, retry_in=round(delay, 2))
+        if delay:
+            await asyncio.sleep(delay)
+
+
+# 调用 Stability API，返回缩放到目标尺寸后的 WebP 字节
+async def request_generation(request_id, input_image, prompt_text, strength, mode, target_size, timings=None,
+                             tier: Optional[GenerationTier] = None):
+    tier = tier or tier_router.tiers[0]
+    data = { "prompt": prompt_text, "output_format": STABILITY_OUTPUT_FORMAT }
+    if tier.model:
+        data["model"] = tier.model
+    # 对于 text-to-image，保持默认的 files={"none": b''}
+    files = {"none": b''}
+
+    if mode == "image-to-image":
+        data['strength'] = strength
+        png_bytes = await image_processor.encode_png(input_image, timings)
+        files = {'image': ('init_image.png', png_bytes, 'image/png')}
+
+    logger.info(f"[Request ID: {request_id}] 正在调用 Stability API（档位: {tier.name}）...")
+    job_events.update(request_id, "calling_api", tier=tier.name)
+
+    with tracer.span("stability.generate", mode=mode, tier=tier.name):
+        response = await post_stability(request_id, data, files, tier.endpoint)
+
+    # 被内容审核过滤时返回的是模糊图，不落盘也不进缓存
+    if response.headers.get("finish-reason") == "CONTENT_FILTERED":
+        raise UpstreamError("content_filtered", "Generated image was flagged by content moderation", 200)
+
+    # 只解析文件头获取格式和尺寸，不解码像素
+    content = response.content
+    with Image.open(io.BytesIO(content)) as probe:
+        returned_format, returned_size = probe.format, probe.size
+    logger.info(f"[Request ID: {request_id}] 从API接收到图片，格式: {returned_format}，原始尺寸: {returned_size}")
+    job_events.update(request_id, "encoding")
+
+    # 已经是目标格式和尺寸时直接落盘，不再解码和重新编码
+    if returned_format == "WEBP" and returned_size == tuple(target_size):
+        return content
+
+    generated_image = await image_processor.decode(content, timings)
+
+    # 2. 尺寸不一致时才将API返回的图片缩放到目标尺寸（LANCZOS 高质量缩放）
+    if returned_size != tuple(target_size):
+        generated_image = await image_processor.resize(generated_image, target_size, timings)
+        logger.info(f"[Request ID: {request_id}] 图片已缩放至目标尺寸: {generated_image.size}")
+
+    return await image_processor.encode_webp(generated_image, timings)
 
         
 # --- Gradio 接口 (保持不变) ---
@@ -432,7 +3409,11 @@ try:
 except Exception as e:
     SAMPLING_MODE = Image.LANCZOS
     
-with gr.Blocks().queue() as blocks:
+with gr.Blocks().queue(
+    concurrency_count=GRADIO_CONCURRENCY,
+    max_size=GRADIO_MAX_QUEUE,
+    status_update_rate=GRADIO_STATUS_UPDATE_RATE,
+) as blocks:
     with gr.Row():
         with gr.Column(scale=3, min_width=270):
             sd_prompt = gr.Textbox(label="Prompt", placeholder="input your prompt here", lines=4)
@@ -465,7 +3446,7 @@ with gr.Blocks().queue() as blocks:
 # --- FastAPI 挂载和启动 (保持不变) ---
 app = gr.mount_gradio_app(app, blocks, "/gradio", gradio_api_url="http://0.0.0.0:7860/gradio/")
 
-app.mount("/storage", StaticFiles(directory=LOCAL_STORAGE_PATH), name="storage")
+app.mount("/storage", storage_files, name="storage")
 # 注意：在容器化部署中，前端由独立的 Nginx 容器提供服务
 # app.mount("/", StaticFiles(directory="../frontend/build", html=True), name="static")
 
@@ -498,4 +3479,6 @@ if __name__ == "__main__":
         db.close()
 
     logger.info(f"服务器启动，文件将保存在本地目录: {LOCAL_STORAGE_PATH.resolve()}")
-    uvicorn.run(app, host="0.0.0.0", port=7860, log_level="info", reload=False)
\ No newline at end of file
+    # log_config=None：不让 uvicorn 给自己的 logger 装同步的 stdout handler，启动和错误日志经根 logger 走后台队列；
+    # 访问日志由 log_requests 中间件按采样规则记录，关掉 uvicorn 自带的那一份
+    uvicorn.run(app, host="0.0.0.0", port=7860, log_level="info", reload=False, log_config=None, access_log=False)
\ No newline at end of file
@@ -0,0 +1,94 @@
+# 生成图片处理流水线的基准测试：对比旧流水线和 app.py 中的单次编码流水线
+# 用法（在 stablediffusion-infinity 目录下）: python benchmark_pipeline.py [重复次数]
+import io
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from app import decode_image, encode_png, encode_webp, is_blank_canvas, resize_image
+
+CANVAS_SIZES = [(512, 512), (1024, 1024), (1920, 1080)]
+API_SIZE = (1024, 1024)  # SD3 默认返回 1:1 的 1024x1024
+
+
+def make_canvas(size):
+    # 平滑渐变加轻微噪声，压缩特性接近真实画面（纯随机噪声会让编码耗时失真）
+    width, height = size
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 4), dtype=np.float32)
+    pixels[..., 0] = x
+    pixels[..., 1] = y
+    pixels[..., 2] = (x + y) / 2
+    pixels[..., :3] += rng.normal(0, 4, (height, width, 3))
+    pixels[..., 3] = 255
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_api_response(size, output_format):
+    buffer = io.BytesIO()
+    make_canvas(size).convert("RGB").save(buffer, format=output_format)
+    return buffer.getvalue()
+
+
+def legacy_pipeline(canvas, api_png):
+    # 与改造前 run_outpaint/upload_file 的处理步骤一致
+    img_np = np.array(canvas.convert("RGB"))
+    np.std(img_np)
+    image_bytes = io.BytesIO()
+    canvas.save(image_bytes, format='PNG')
+    generated = Image.open(io.BytesIO(api_png))
+    resized = generated.resize(canvas.size, Image.LANCZOS)
+    out = io.BytesIO()
+    resized.convert('RGB').save(out, format="WEBP")
+    return out.getvalue()
+
+
+def current_pipeline(canvas, api_bytes):
+    is_blank_canvas(canvas)
+    encode_png(canvas)
+    generated = decode_image(api_bytes)
+    if generated.size != canvas.size:
+        generated = resize_image(generated, canvas.size)
+    return encode_webp(generated)
+
+
+def measure(func, *args, repeat=3):
+    durations = []
+    peak = 0
+    pillow_blocks = 0
+    for _ in range(repeat):
+        blocks_before = Image.core.get_stats()["new_count"]
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        pillow_blocks += Image.core.get_stats()["new_count"] - blocks_before
+    return min(durations), peak, pillow_blocks // repeat
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f"{'canvas':>10} {'pipeline':>10} {'latency(ms)':>12} {'py peak(KB)':>12} {'PIL images':>11}")
+    for size in CANVAS_SIZES:
+        canvas = make_canvas(size)
+        api_png = make_api_response(API_SIZE, "PNG")
+        cases = [("legacy", legacy_pipeline, api_png), ("current", current_pipeline, api_png)]
+        if size == API_SIZE:
+            # 端点直接返回目标格式和尺寸时，字节原样落盘
+            api_webp = make_api_response(API_SIZE, "WEBP")
+            cases.append(("passthru", lambda c, b: (is_blank_canvas(c), encode_png(c), b), api_webp))
+        for name, func, api_bytes in cases:
+            latency, peak, blocks = measure(func, canvas, api_bytes, repeat=repeat)
+            label = f"{size[0]}x{size[1]}"
+            print(f"{label:>10} {name:>10} {latency * 1000:>12.1f} {peak / 1024:>12.0f} {blocks:>11}")
+
+
+if __name__ == "__main__":
+    main()
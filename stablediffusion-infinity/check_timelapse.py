@@ -0,0 +1,63 @@
+# 延时动画拼接的回归检查：按导出接口的方式分段编码、拆出 ANMF 帧块再拼接，确认帧数和总时长都不丢
+# 覆盖单帧房间、恰好多出一帧的房间（最后一段只有一帧）和整段帧完全相同（libwebp 输出静态 WebP）的情况
+# 用法（在 stablediffusion-infinity 目录下）: python check_timelapse.py
+import io
+import struct
+import sys
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+from app import TIMELAPSE_SEGMENT_FRAMES, encode_timelapse_segment, split_animated_webp
+
+SIZE = 64
+DURATION = 250
+
+
+def make_frames(directory: Path, count: int, identical: bool):
+    paths = []
+    for i in range(count):
+        color = (40, 80, 120) if identical else ((i * 37) % 256, (i * 91) % 256, (i * 13) % 256)
+        path = directory / f"{i}.webp"
+        Image.new("RGB", (SIZE, SIZE), color).save(path, format="WEBP")
+        paths.append(path)
+    return paths
+
+
+def export(paths) -> bytes:
+    segments = [paths[i:i + TIMELAPSE_SEGMENT_FRAMES] for i in range(0, len(paths), TIMELAPSE_SEGMENT_FRAMES)]
+    header, body = b"", b""
+    for segment in segments:
+        data = encode_timelapse_segment(segment, SIZE, DURATION)
+        segment_header, frames = split_animated_webp(data, SIZE, DURATION * len(segment))
+        header = header or segment_header
+        body += frames
+    return b"RIFF" + struct.pack("<I", 4 + len(header) + len(body)) + b"WEBP" + header + body
+
+
+def check(count: int, identical: bool) -> bool:
+    with tempfile.TemporaryDirectory() as directory:
+        data = export(make_frames(Path(directory), count, identical))
+    with Image.open(io.BytesIO(data)) as image:
+        frames, total = 0, 0
+        for index in range(getattr(image, "n_frames", 1)):
+            image.seek(index)
+            image.load()
+            frames += 1
+            total += image.info.get("duration", 0)
+    # 相同的连续帧会被 libwebp 合并成一帧并累加时长，所以总时长是可靠的判据；各帧不同时帧数也必须一致
+    ok = total == count * DURATION and (identical or frames == count)
+    label = "identical" if identical else "distinct"
+    print(f"{count:>4} 帧 ({label:>9}): 解码 {frames} 帧，总时长 {total}ms -> {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+def main():
+    counts = [1, 2, TIMELAPSE_SEGMENT_FRAMES, TIMELAPSE_SEGMENT_FRAMES + 1, TIMELAPSE_SEGMENT_FRAMES * 2 + 1]
+    results = [check(count, identical) for count in counts for identical in (False, True)]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Stability API 故障注入桩：在本地模拟 /v2beta/stable-image/generate/{sd3,ultra,...}，按比例或按脚本注入 429、5xx、超时和内容过滤，
+# 用于验证 app.py 的重试、退避、熔断和档位路由逻辑
+# 用法:
+#   python fault_stub.py --port 7870 --rate-limit 0.2 --retry-after 2 --server-error 0.2
+#   python fault_stub.py --script 503,503,429,200 --latency 0.5
+#   python fault_stub.py --down-for 60    # 启动后 60 秒内全部返回 503，用来观察熔断和恢复
+#   python fault_stub.py --key-rate 2     # 每个 API key 每秒最多 2 个请求，超出返回 429，用来验证 key 池和本地限流
+#   python fault_stub.py --model-latency sd3.5-large=3,sd3.5-large-turbo=0.5   # 按 model 参数模拟不同档位的耗时
+# 后端这样指向它:
+#   STABILITY_API_URL=http://localhost:7870/v2beta/stable-image/generate/sd3 python app.py
+import asyncio
+import io
+import itertools
+import random
+import time
+
+import click
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from PIL import Image
+
+
+def make_image(output_format: str, size=(1024, 1024)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, tuple(random.randint(0, 255) for _ in range(3))).save(
+        buffer, format="WEBP" if output_format == "webp" else "PNG"
+    )
+    return buffer.getvalue()
+
+
+def create_app(rate_limit: float, retry_after: str, server_error: float, timeout: float, timeout_seconds: float,
+               content_filtered: float, latency: float, down_for: float, script, key_rate: float = 0,
+               model_latency=None):
+    app = FastAPI()
+    started = time.time()
+    stats = {}
+    scripted = itertools.cycle(script) if script else None
+    key_windows = {}  # authorization -> (当前秒, 该秒内的请求数)
+
+    def pick_fault() -> str:
+        if down_for and time.time() - started < down_for:
+            return "503"
+        if scripted is not None:
+            return next(scripted)
+        roll = random.random()
+        for fault, rate in (("429", rate_limit), ("503", server_error), ("timeout", timeout),
+                            ("filtered", content_filtered)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return "200"
+
+    def over_key_rate(authorization: str) -> bool:
+        second = int(time.time())
+        window, count = key_windows.get(authorization, (second, 0))
+        if window != second:
+            window, count = second, 0
+        key_windows[authorization] = (window, count + 1)
+        return count + 1 > key_rate
+
+    @app.post("/v2beta/stable-image/generate/{endpoint}")
+    async def generate(endpoint: str, request: Request):
+        form = await request.form()
+        authorization = request.headers.get("authorization", "")
+        fault = "429" if key_rate and over_key_rate(authorization) else pick_fault()
+        per_key = stats.setdefault("keys", {})
+        per_key[authorization[-4:]] = per_key.get(authorization[-4:], 0) + 1
+        stats[fault] = stats.get(fault, 0) + 1
+        model = form.get("model") or endpoint
+        per_model = stats.setdefault("models", {})
+        per_model[model] = per_model.get(model, 0) + 1
+        delay = latency + (model_latency or {}).get(model, 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if fault == "timeout":
+            # 比后端的读取超时更久，触发 ReadTimeout
+            await asyncio.sleep(timeout_seconds)
+            fault = "200"
+        if fault == "429":
+            return JSONResponse(status_code=429, content={"errors": ["rate limited"]},
+                                headers={"Retry-After": retry_after})
+        if fault.isdigit() and fault != "200":
+            return JSONResponse(status_code=int(fault), content={"errors": [f"injected {fault}"]})
+
+        output_format = form.get("output_format", "png")
+        return Response(
+            content=make_image(output_format),
+            media_type=f"image/{output_format}",
+            headers={"finish-reason": "CONTENT_FILTERED" if fault == "filtered" else "SUCCESS"},
+        )
+
+    @app.get("/stats")
+    async def get_stats():
+        return {"uptime": round(time.time() - started, 1), "responses": stats}
+
+    return app
+
+
+@click.command()
+@click.option("--port", type=int, default=7870, help="监听端口")
+@click.option("--rate-limit", type=float, default=0.0, help="返回 429 的比例")
+@click.option("--retry-after", default="1", help="429 响应的 Retry-After（秒数或 HTTP 日期）")
+@click.option("--server-error", type=float, default=0.0, help="返回 503 的比例")
+@click.option("--timeout", type=float, default=0.0, help="长时间不响应的比例")
+@click.option("--timeout-seconds", type=float, default=180, help="不响应时挂起的秒数，应大于 STABILITY_READ_TIMEOUT")
+@click.option("--content-filtered", type=float, default=0.0, help="返回 finish-reason: CONTENT_FILTERED 的比例")
+@click.option("--latency", type=float, default=0.0, help="每个请求额外的延迟（秒）")
+@click.option("--down-for", type=float, default=0.0, help="启动后这么多秒内全部返回 503")
+@click.option("--script", default="", help="按顺序循环返回的结果，例如 503,429,200；可用 timeout、filtered")
+@click.option("--key-rate", type=float, default=0.0, help="每个 API key 每秒允许的请求数，0 表示不限")
+@click.option("--model-latency", default="", help="按 model（或 endpoint）追加的延迟，例如 sd3.5-large=3,sd3.5-large-turbo=0.5")
+def main(port, rate_limit, retry_after, server_error, timeout, timeout_seconds, content_filtered, latency,
+         down_for, script, key_rate, model_latency):
+    """启动模拟 Stability API 的故障注入桩"""
+    script = [item.strip() for item in script.split(",") if item.strip()]
+    model_latency = {
+        name.strip(): float(seconds)
+        for name, _, seconds in (item.partition("=") for item in model_latency.split(",") if "=" in item)
+    }
+    app = create_app(rate_limit, retry_after, server_error, timeout, timeout_seconds, content_filtered, latency,
+                     down_for, script, key_rate, model_latency)
+    uvicorn.run(app, host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main()
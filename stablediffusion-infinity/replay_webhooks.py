@@ -0,0 +1,128 @@
+# Liveblocks webhook 回放工具：把录制的事件流（或合成事件）签名后发送到本地后端，用于压测 webhook 接入
+# 用法:
+#   python replay_webhooks.py events.ndjson --url http://localhost:7860/server/api/liveblocks/webhook
+#   python replay_webhooks.py --synthetic 5000 --rooms 41 --concurrency 32
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+
+import click
+import httpx
+import shortuuid
+from dotenv import load_dotenv
+
+
+def sign(body: bytes, secret: str, webhook_id: str, timestamp: str) -> str:
+    key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    signed = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    return "v1," + base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+
+
+def load_events(path):
+    """每行一个事件；既可以是 webhook 原始 body，也可以是 {"body": {...}} 形式的录制记录"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                yield record.get("body", record)
+
+
+def synthetic_events(count: int, rooms: int):
+    """随机生成 userEntered/userLeft 事件，人数不会低于 0"""
+    active = {f"room-{i}": 0 for i in range(rooms)}
+    for _ in range(count):
+        room_id = random.choice(list(active))
+        entered = active[room_id] == 0 or random.random() < 0.55
+        active[room_id] += 1 if entered else -1
+        yield {
+            "type": "userEntered" if entered else "userLeft",
+            "data": {
+                "projectId": "replay",
+                "roomId": room_id,
+                "connectionId": random.randint(1, 10_000),
+                "userId": shortuuid.uuid(),
+                "numActiveUsers": active[room_id],
+            },
+        }
+
+
+async def replay(events, url: str, secret: str, concurrency: int, rate: float):
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    latencies = []
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def send(event):
+            body = json.dumps(event).encode("utf-8")
+            webhook_id = f"msg_{shortuuid.uuid()}"
+            timestamp = str(int(time.time()))
+            headers = {
+                "content-type": "application/json",
+                "webhook-id": webhook_id,
+                "webhook-timestamp": timestamp,
+                "webhook-signature": sign(body, secret, webhook_id, timestamp),
+            }
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, content=body, headers=headers)
+                    key = response.status_code
+                except httpx.HTTPError as e:
+                    key = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[key] = statuses.get(key, 0) + 1
+
+        tasks = []
+        started = time.perf_counter()
+        for index, event in enumerate(events):
+            if rate > 0:
+                # 按目标速率匀速发送
+                delay = started + index / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(event)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    return statuses, latencies, elapsed
+
+
+@click.command()
+@click.argument("events_file", required=False)
+@click.option("--url", default="http://localhost:7860/server/api/liveblocks/webhook", help="webhook 接收地址")
+@click.option("--secret", default=None, help="签名密钥，默认读取 LIVEBLOCKS_WEBHOOK_SECRET")
+@click.option("--synthetic", type=int, default=0, help="不读取文件，改为生成指定数量的合成事件")
+@click.option("--rooms", type=int, default=41, help="合成事件涉及的房间数量")
+@click.option("--concurrency", type=int, default=16, help="同时在途的请求数")
+@click.option("--rate", type=float, default=0, help="每秒发送的事件数，0 表示不限速")
+def main(events_file, url, secret, synthetic, rooms, concurrency, rate):
+    """签名并回放 Liveblocks webhook 事件流"""
+    load_dotenv()
+    secret = secret or os.environ.get("LIVEBLOCKS_WEBHOOK_SECRET")
+    if not secret:
+        raise click.UsageError("缺少签名密钥：请设置 LIVEBLOCKS_WEBHOOK_SECRET 或使用 --secret")
+    if events_file:
+        events = list(load_events(events_file))
+    elif synthetic:
+        events = list(synthetic_events(synthetic, rooms))
+    else:
+        raise click.UsageError("请指定事件文件或 --synthetic 数量")
+
+    statuses, latencies, elapsed = asyncio.run(replay(events, url, secret, concurrency, rate))
+    latencies.sort()
+    click.echo(f"发送 {len(events)} 个事件，耗时 {elapsed:.2f} 秒，{len(events) / elapsed:.1f} 个/秒")
+    click.echo(f"状态码分布: {statuses}")
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        click.echo(f"延迟 p50={p50 * 1000:.1f}ms p99={p99 * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import base64
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+import httpx
+import pytest
+
+APP_DIR = Path(__file__).resolve().parent.parent
+WORK_DIR = Path(tempfile.mkdtemp(prefix="sd-infinity-tests-"))
+WEBHOOK_SECRET = "whsec_" + base64.b64encode(b"test-webhook-secret").decode()
+
+# app 在导入时读取环境变量，数据库和存储目录都相对于当前工作目录，
+# 所以要在导入之前切到临时目录并准备好 rooms.db
+os.environ.update({
+    "STABILITY_API_KEY": "test-key",
+    "STABILITY_API_KEYS": "",
+    "STABILITY_BACKOFF_BASE": "0",
+    "LIVEBLOCKS_SECRET": "",
+    "LIVEBLOCKS_WEBHOOK_SECRET": WEBHOOK_SECRET,
+    "LOG_FORMAT": "text",
+    "LOG_LEVEL": "WARNING",
+    "GENERATION_CACHE_PATH": str(WORK_DIR / "cache" / "generation"),
+    "DERIVATIVE_CACHE_PATH": str(WORK_DIR / "cache" / "derivatives"),
+    "TIMELAPSE_CACHE_PATH": str(WORK_DIR / "cache" / "timelapse"),
+})
+os.chdir(WORK_DIR)
+(WORK_DIR / "local_storage" / "gallery").mkdir(parents=True)
+with sqlite3.connect(WORK_DIR / "rooms.db") as db:
+    db.executescript((APP_DIR / "schema.sql").read_text())
+sys.path.insert(0, str(APP_DIR))
+
+import app as sd_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    # 启动时的房间人数同步会请求 Liveblocks，测试里固定返回没有在线用户
+    sd_app.liveblocks_client._client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, json={"data": []}))
+    )
+    with TestClient(sd_app.app) as test_client:
+        yield test_client
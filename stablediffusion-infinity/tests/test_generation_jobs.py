@@ -0,0 +1,34 @@
+import pytest
+
+JOBS_URL = "/server/api/generation/jobs"
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"data": "not json", "headers": {"content-type": "application/json"}},
+    {"json": ["image", "prompt"]},
+    {"json": {"prompt": "a cat"}},
+    {"json": {"image": "data:image/webp;base64,AAAA", "strength": "strong"}},
+    {"json": {"image": "data:image/webp;base64,AAAA", "strength": 1.5}},
+    {"json": {"image": "data:image/webp;base64,AAAA", "strength": -0.1}},
+], ids=["not-json", "not-object", "missing-image", "non-numeric-strength", "strength-above-1",
+        "strength-below-0"])
+def test_invalid_body_is_rejected(client, kwargs):
+    response = client.post(JOBS_URL, **kwargs)
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid request body")
+
+
+def test_invalid_room_id_is_rejected(client):
+    response = client.post(JOBS_URL, json={"image": "data:image/webp;base64,AAAA", "room_id": "../etc"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid room id"
+
+
+def test_undecodable_image_is_rejected(client):
+    response = client.post(JOBS_URL, json={"image": "data:image/webp;base64,bm90IGFuIGltYWdl"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid image"
+
+
+def test_unknown_job_is_not_found(client):
+    assert client.get(f"{JOBS_URL}/missing").status_code == 404
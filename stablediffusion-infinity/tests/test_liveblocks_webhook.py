@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+import app as sd_app
+from conftest import WEBHOOK_SECRET
+
+WEBHOOK_URL = "/server/api/liveblocks/webhook"
+
+
+def sign(body: bytes, webhook_id: str = "msg_1", timestamp: int = None, secret: str = WEBHOOK_SECRET) -> dict:
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    key = base64.b64decode(secret.split("_", 1)[1])
+    signed = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    signature = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    return {"webhook-id": webhook_id, "webhook-timestamp": str(timestamp), "webhook-signature": f"v1,{signature}"}
+
+
+BODY = json.dumps({"type": "userEntered", "data": {"roomId": "room-1", "numActiveUsers": 3}}).encode()
+
+
+def test_valid_signature():
+    assert sd_app.verify_liveblocks_webhook(BODY, sign(BODY), WEBHOOK_SECRET)
+
+
+def test_any_of_several_signatures_may_match():
+    headers = sign(BODY)
+    headers["webhook-signature"] = "v1,bm90LXRoaXMtb25l " + headers["webhook-signature"]
+    assert sd_app.verify_liveblocks_webhook(BODY, headers, WEBHOOK_SECRET)
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda body, headers: (body + b" ", headers),
+    lambda body, headers: (body, {**headers, "webhook-id": "msg_2"}),
+    lambda body, headers: (body, sign(body, secret="whsec_" + base64.b64encode(b"other").decode())),
+    lambda body, headers: (body, sign(body, timestamp=int(time.time()) - 3600)),
+    lambda body, headers: (body, {**headers, "webhook-timestamp": "soon"}),
+    lambda body, headers: (body, {**headers, "webhook-signature": headers["webhook-signature"].replace("v1,", "v2,")}),
+    lambda body, headers: (body, {key: value for key, value in headers.items() if key != "webhook-signature"}),
+], ids=["body", "id", "secret", "stale", "bad-timestamp", "version", "missing-header"])
+def test_invalid_signature(tamper):
+    body, headers = tamper(BODY, sign(BODY))
+    assert not sd_app.verify_liveblocks_webhook(body, headers, WEBHOOK_SECRET)
+
+
+def test_endpoint_rejects_bad_signature(client):
+    headers = sign(BODY)
+    response = client.post(WEBHOOK_URL, data=BODY + b" ", headers=headers)
+    assert response.status_code == 401
+
+
+def test_endpoint_applies_presence_once(client):
+    headers = sign(BODY, webhook_id="msg_presence")
+    response = client.post(WEBHOOK_URL, data=BODY, headers=headers)
+    assert response.json() == {"status": "ok", "room_id": "room-1", "users_count": 3}
+    rooms = {room["room_id"]: room["users_count"] for room in client.get("/server/api/rooms").json()}
+    assert rooms["room-1"] == 3
+
+    # Liveblocks 重试投递同一个事件时不再重复计数
+    response = client.post(WEBHOOK_URL, data=BODY, headers=headers)
+    assert response.json() == {"status": "duplicate"}
+
+
+def test_endpoint_ignores_other_events(client):
+    body = json.dumps({"type": "storageUpdated", "data": {"roomId": "room-1"}}).encode()
+    response = client.post(WEBHOOK_URL, data=body, headers=sign(body, webhook_id="msg_storage"))
+    assert response.json() == {"status": "ignored"}
+
+
+def test_endpoint_rejects_non_object_payload(client):
+    body = b"[1, 2, 3]"
+    response = client.post(WEBHOOK_URL, data=body, headers=sign(body, webhook_id="msg_list"))
+    assert response.status_code == 400
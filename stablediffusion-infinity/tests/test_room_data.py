@@ -0,0 +1,69 @@
+import json
+import sqlite3
+
+import pytest
+
+from conftest import WORK_DIR
+
+ROOM_ID = "history-room"
+
+
+@pytest.fixture(scope="module")
+def history(client):
+    # 前两行时间相同，分页必须按 rowid 区分，不能漏行或重复
+    rows = [
+        (ROOM_ID, "0_0", "a cat", "2024-01-01 00:00:00", 0, 0),
+        (ROOM_ID, "0_1", "a dog", "2024-01-01 00:00:00", 0, 512),
+        (ROOM_ID, "1_0", "a bird", "2024-01-01 00:00:01", 512, 0),
+        ("other-room", "0_0", "a fish", "2024-01-01 00:00:01", 0, 0),
+        (ROOM_ID, "1_1", "a fox", "2024-01-01 00:00:02", 512, 512),
+        (ROOM_ID, "2_0", "a cow", "2024-01-01 00:00:03", 1024, 0),
+    ]
+    with sqlite3.connect(WORK_DIR / "rooms_data.db") as db:
+        db.executemany("INSERT INTO rooms_data (room_id, key, prompt, time, x, y) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return [{"key": key, "prompt": prompt, "time": at, "x": x, "y": y}
+            for room_id, key, prompt, at, x, y in rows if room_id == ROOM_ID]
+
+
+def test_full_list_without_paging(client, history):
+    response = client.get(f"/server/api/room_data/{ROOM_ID}")
+    assert response.status_code == 200
+    assert response.json() == history
+
+
+def test_cursor_pages_cover_history_once(client, history):
+    items, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        page = client.get(f"/server/api/room_data/{ROOM_ID}", params=params).json()
+        pages += 1
+        assert len(page["items"]) <= 2
+        items.extend(page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == 3
+    assert items == history
+
+
+def test_cursor_respects_time_range(client, history):
+    params = {"limit": 1, "start": "2024-01-01 00:00:01", "end": "2024-01-01 00:00:02"}
+    first = client.get(f"/server/api/room_data/{ROOM_ID}", params=params).json()
+    assert first["items"] == history[2:3]
+    second = client.get(f"/server/api/room_data/{ROOM_ID}", params={**params, "cursor": first["next_cursor"]}).json()
+    assert second["items"] == history[3:4]
+    assert second["next_cursor"] is None
+
+
+def test_ndjson_stream_matches_list(client, history):
+    response = client.get(f"/server/api/room_data/{ROOM_ID}", params={"format": "ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line) for line in response.text.splitlines()] == history
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "WzFd", "eyJhIjogMX0="])
+def test_invalid_cursor_is_rejected(client, history, cursor):
+    response = client.get(f"/server/api/room_data/{ROOM_ID}", params={"cursor": cursor})
+    assert response.status_code == 400
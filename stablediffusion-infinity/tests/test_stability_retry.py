@@ -0,0 +1,206 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+import app as sd_app
+
+
+class FakeUpstream:
+    """按顺序返回预设的响应或抛出预设的传输错误，并记录收到的请求"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, type) and issubclass(outcome, Exception):
+            raise outcome("simulated", request=request)
+        if isinstance(outcome, int):
+            return httpx.Response(outcome, content=b"image" if outcome == 200 else b"error")
+        return outcome
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    endpoint = sd_app.StabilityEndpoint(name="test", key="test-key", url=sd_app.STABILITY_API_URL,
+                                        weight=1, rate=1000, burst=1000)
+    monkeypatch.setattr(sd_app, "stability_pool", sd_app.StabilityKeyPool([endpoint], "least_loaded"))
+    return endpoint
+
+
+def call(monkeypatch, upstream):
+    monkeypatch.setattr(sd_app.http_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    return asyncio.run(sd_app.post_stability("test", {"prompt": "a cat"}, {"none": b""}))
+
+
+def test_success_on_first_attempt(monkeypatch, endpoint):
+    upstream = FakeUpstream(200)
+    assert call(monkeypatch, upstream).content == b"image"
+    assert len(upstream.requests) == 1
+    assert upstream.requests[0].url.path.endswith("/sd3")
+
+
+@pytest.mark.parametrize("failure", [500, 502, 503, 504, httpx.ConnectError, httpx.ConnectTimeout])
+def test_retries_errors_before_the_request_reaches_the_model(monkeypatch, endpoint, failure):
+    upstream = FakeUpstream(failure, 200)
+    assert call(monkeypatch, upstream).status_code == 200
+    assert len(upstream.requests) == 2
+    assert endpoint.breaker.failures == 0
+
+
+def test_gives_up_after_max_retries(monkeypatch, endpoint):
+    upstream = FakeUpstream(503)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, upstream)
+    assert raised.value.code == "upstream_unavailable"
+    assert len(upstream.requests) == sd_app.STABILITY_MAX_RETRIES + 1
+
+
+@pytest.mark.parametrize("failure, code", [
+    (httpx.ReadTimeout, "upstream_timeout"),
+    (httpx.ReadError, "upstream_unavailable"),
+    (httpx.RemoteProtocolError, "upstream_unavailable"),
+])
+def test_does_not_resend_a_request_that_may_have_been_accepted(monkeypatch, endpoint, failure, code):
+    upstream = FakeUpstream(failure, 200)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, upstream)
+    assert raised.value.code == code
+    assert len(upstream.requests) == 1
+    assert endpoint.breaker.failures == 1
+
+
+@pytest.mark.parametrize("status_code, code", [(400, "bad_request"), (403, "content_filtered"),
+                                               (413, "bad_request")])
+def test_client_errors_fail_fast_without_tripping_the_breaker(monkeypatch, endpoint, status_code, code):
+    upstream = FakeUpstream(status_code, 200)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, upstream)
+    assert raised.value.code == code
+    assert len(upstream.requests) == 1
+    assert endpoint.breaker.failures == 0
+
+
+def test_rate_limit_is_retried_without_counting_as_failure(monkeypatch, endpoint):
+    upstream = FakeUpstream(httpx.Response(429, headers={"retry-after": "0"}), 200)
+    assert call(monkeypatch, upstream).status_code == 200
+    assert len(upstream.requests) == 2
+    assert endpoint.breaker.failures == 0
+
+
+def test_long_retry_after_is_returned_to_the_caller(monkeypatch, endpoint):
+    retry_after = sd_app.STABILITY_RETRY_AFTER_MAX + 30
+    upstream = FakeUpstream(httpx.Response(429, headers={"retry-after": str(retry_after)}), 200)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, upstream)
+    assert raised.value.code == "rate_limited"
+    assert raised.value.retry_after == pytest.approx(retry_after, abs=1)
+    assert len(upstream.requests) == 1
+
+
+def test_open_circuit_fails_without_calling_upstream(monkeypatch, endpoint):
+    for _ in range(endpoint.breaker.failure_threshold):
+        endpoint.breaker.record_failure()
+    upstream = FakeUpstream(200)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, upstream)
+    assert raised.value.code == "circuit_open"
+    assert raised.value.retry_after >= 1
+    assert upstream.requests == []
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = sd_app.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allows_call()
+    with pytest.raises(sd_app.UpstreamError):
+        breaker.before_call()
+
+
+def open_breaker(reset_timeout=30):
+    breaker = sd_app.CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    # 把熔断时间拨回去，直接进入 half-open
+    breaker.opened_at -= reset_timeout
+    return breaker
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = open_breaker()
+    assert breaker.state == "half_open"
+    assert breaker.before_call() is True
+    assert not breaker.allows_call()
+    with pytest.raises(sd_app.UpstreamError):
+        breaker.before_call()
+
+
+def test_successful_probe_closes_the_breaker():
+    breaker = open_breaker()
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is False
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = open_breaker()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_unfinished_probe_returns_the_slot():
+    breaker = open_breaker()
+    breaker.before_call()
+    breaker.end_probe()
+    assert breaker.state == "half_open"
+    assert breaker.before_call() is True
+
+
+def test_probe_slot_is_returned_after_rate_limit(monkeypatch, endpoint):
+    for _ in range(endpoint.breaker.failure_threshold):
+        endpoint.breaker.record_failure()
+    endpoint.breaker.opened_at -= endpoint.breaker.reset_timeout
+    monkeypatch.setattr(sd_app, "STABILITY_MAX_RETRIES", 0)
+    with pytest.raises(sd_app.UpstreamError) as raised:
+        call(monkeypatch, FakeUpstream(httpx.Response(429, headers={"retry-after": "0"})))
+    assert raised.value.code == "rate_limited"
+    assert endpoint.breaker.state == "half_open"
+    assert endpoint.breaker.allows_call()
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("12", 12.0),
+    ("1.5", 1.5),
+    ("-3", 0.0),
+    ("soon", None),
+])
+def test_parse_retry_after(value, expected):
+    assert sd_app.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    assert sd_app.parse_retry_after(formatdate(time.time() + 60, usegmt=True)) == pytest.approx(60, abs=2)
+    assert sd_app.parse_retry_after(formatdate(time.time() - 60, usegmt=True)) == 0.0
+
+
+def test_backoff_delay_is_capped(monkeypatch):
+    monkeypatch.setattr(sd_app, "STABILITY_BACKOFF_BASE", 0.5)
+    monkeypatch.setattr(sd_app, "STABILITY_BACKOFF_MAX", 2)
+    assert all(0 <= sd_app.backoff_delay(attempt) <= 0.5 for attempt in [0] * 50)
+    assert all(0 <= sd_app.backoff_delay(attempt) <= 2 for attempt in [10] * 50)